@@ -1,8 +1,16 @@
 import logging
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dokucolumns import open_columns
+from dokudb import DokuDbWriter, DokuDbSync
+from dokuindex import DokuIndex
+from dokumetrics import DokuMetrics
 from dokunamespace import DokuNamespace, DokuRoot
-from dokutree import DokuPagesTree, DokuMediaTree, DokuAttic, DokuMediaAttic, DokuMetaTree
+from dokupool import open_pool
+from dokureport import DokuReport, open_sink
+from dokusnapshot import DokuSnapshot
+from dokutree import DokuPagesTree, DokuMediaTree, DokuAttic, DokuMediaAttic, DokuMetaTree, DokuScanManifest
 
 
 class Doku:
@@ -10,28 +18,126 @@ class Doku:
     """
     #: Database definition script filename
     ddl = 'dokudata.ddl'
+    #: Data trees, in loading order: attic and meta entries attach to previously loaded nodes
+    trees = (DokuPagesTree, DokuMediaTree, DokuAttic, DokuMediaAttic, DokuMetaTree)
 
     def __init__(self, path):
         self.path = path
         self.version = self.readVersion()
         self.root = DokuRoot(self)
+        #: counters and timers of the work done on this site
+        self.metrics = DokuMetrics()
+        self.index = None
 
     def readVersion(self):
         with open(os.path.join(self.path,'VERSION')) as f:
              s = f.readline()
         return s.strip()
 
-    def load(self):
-        """Scans a directory tree and builds site structure"""
-        DokuPagesTree(self.root).loadRoot()
-        DokuMediaTree(self.root).loadRoot()
-        DokuAttic(self.root).loadRoot()
-        DokuMediaAttic(self.root).loadRoot()
-        DokuMetaTree(self.root).loadRoot()
+    def load(self, iterative=False, workers=0, split=False, manifest=None, parse_workers=0, snapshot=None,
+             verify=False):
+        """Scans a directory tree and builds site structure
+
+        With `workers`, trees are scanned concurrently by a pool of threads,
+        while scan results are merged into the namespace graph by the calling thread,
+        in the same order as a sequential load. Hence attic and meta entries
+        still find the pages and medias loaded before them, and warnings about
+        missing ones are unchanged.
+
+        :param iterative: walk directories without recursion, for very deep namespaces
+        :param workers: number of scanning threads, 0 for a sequential load
+        :param split: with `workers`, also scan each top-level namespace as a separate task
+        :param manifest: scan manifest filename; when given, directories unchanged since the previous
+            load are not listed again, and the manifest is updated, see :py:class:`DokuScanManifest`
+        :param parse_workers: number of processes parsing .changes files and verifying attic files,
+            0 to do so while scanning
+        :param verify: check the integrity of attic files, recording their uncompressed size and digest,
+            see :py:class:`DokuAtticContent`
+        :param snapshot: :py:class:`DokuSnapshot` filename; the site is restored from it when
+            data trees did not change since it was saved, otherwise it is loaded and the snapshot saved
+        """
+        self.index = None
+        if snapshot:
+            snapshot = DokuSnapshot(snapshot, self, verify)
+            if snapshot.restore():
+                return
+        if manifest:
+            manifest = DokuScanManifest(manifest, self.root.getDataPath())
+        metrics = self.metrics
+        with metrics.phase('load'), open_pool(parse_workers) as pool:
+            trees = [cls(self.root, manifest=manifest, executor=pool, verify=verify) for cls in self.trees]
+            if not workers:
+                for tree in trees:
+                    with metrics.phase('load.' + tree.treename):
+                        tree.loadRoot(iterative)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    jobs = []
+                    for tree in trees:
+                        futures = [executor.submit(task) for task in tree.scanTasks(iterative, split)]
+                        jobs.append((tree, futures))
+                    for tree, futures in jobs:
+                        with metrics.phase('load.' + tree.treename):
+                            for future in futures:
+                                tree.apply(self.root, future.result())
+                            tree.finish()
+            if manifest:
+                manifest.save()
+        for tree in trees:
+            metrics.addTree(tree.treename, tree.counters)
+        if snapshot:
+            snapshot.save()
+
+    def walk(self, parse_workers=0, verify=False):
+        """Scans the directory tree one namespace at a time.
+
+        Yields each namespace once its own pages and medias are loaded from all trees,
+        without loading its children. Nodes only depend on entries of their own namespace,
+        so a consumer may :py:meth:`DokuNamespace.release` them once processed, keeping
+        memory use bounded by the size of a namespace rather than of the whole site.
+        There is no scan manifest here, as it would grow with the whole site.
+        """
+        with open_pool(parse_workers) as pool:
+            trees = [cls(self.root, executor=pool, verify=verify) for cls in self.trees]
+            stack = [((), self.root)]
+            while stack:
+                parts, ns = stack.pop()
+                subdirs = {}
+                for tree in trees:
+                    try:
+                        files, subs = tree.scandir(parts, ns.getPathFor(tree.treename))
+                    except FileNotFoundError:
+                        continue
+                    tree.apply(ns, [((), files)])
+                    tree.finish()
+                    subdirs.update(subs)
+                yield ns
+                for entry in reversed(list(subdirs)):
+                    stack.append((parts + (entry,), ns.getNamespace(entry)))
+        for tree in trees:
+            self.metrics.addTree(tree.treename, tree.counters)
+
+    def getIndex(self):
+        """Returns the :py:class:`DokuIndex` of the loaded site, built on first call."""
+        if self.index is None:
+            with self.metrics.phase('index'):
+                self.index = DokuIndex(self.root)
+        return self.index
 
     def summary(self):
         self.root.summary()
 
+    def report(self, output='-', title=None, **options):
+        """Writes the org-mode :py:class:`DokuReport` of the site into `output`,
+        see :py:func:`open_sink`, with an optional `title` line.
+
+        `options` are those of :py:class:`DokuReport`.
+        """
+        with self.metrics.phase('report'), open_sink(output) as out:
+            if title:
+                out.write("#+TITLE %s\n" % title)
+            DokuReport(**options).write(self.root, out)
+
 
     def create_database(self, db, overwrite=False):
         """ Create database tables.
@@ -58,17 +164,60 @@ class Doku:
         conn.commit()
         return conn
 
-    def persist2db(self, db, overwrite=False):
-        conn = self.create_database(db, overwrite)
-        c = conn.cursor()
-        self.root.persist2db(c)
-        # Save (commit) the changes
-        conn.commit()
+    def persist2db(self, db, overwrite=False, batch_size=50000, pragmas=None, sync=False, rollups=False):
+        """Writes the site structure into a new sqlite database.
+
+        :param batch_size: number of rows buffered by the :py:class:`DokuDbWriter` between flushes
+        :param pragmas: PRAGMA settings for the load, overriding :py:attr:`DokuDbWriter.pragmas`
+        :param sync: update an existing database in place, see :py:class:`DokuDbSync`
+        :param rollups: also build the node_stats and ns_stats summary tables,
+            see :py:attr:`DokuDbWriter.rollups`
+        """
+        with self.metrics.phase('persist2db'):
+            writer = self.open_writer(db, overwrite, batch_size, pragmas, sync, rollups)
+            self.root.persist2db(writer)
+            # Save (commit) the changes
+            writer.close()
+        self.metrics.addRows(writer.written)
 
 
         # We can also close the connection if we are done with it.
         # Just be sure any changes have been committed or they will be lost.
-        conn.close()
+        writer.conn.close()
+
+    def persist2columns(self, path, format=None, batch_size=50000):
+        """Writes the site structure as columnar files into directory `path`, see :py:mod:`dokucolumns`.
+
+        :param format: ``parquet`` or ``npy``, by default parquet when :py:mod:`pyarrow` is installed
+        :param batch_size: number of rows of a row group
+        """
+        with self.metrics.phase('persist2columns'):
+            writer = open_columns(path, format, batch_size)
+            self.root.persist2db(writer)
+            writer.close()
+        self.metrics.addRows(writer.written)
+
+    def open_writer(self, db, overwrite=False, batch_size=50000, pragmas=None, sync=False, rollups=False):
+        """Returns a :py:class:`DokuDbWriter` on a new database,
+        or a :py:class:`DokuDbSync` on an existing one with `sync`."""
+        if sync and os.path.exists(db):
+            return DokuDbSync(sqlite3.connect(db), batch_size, pragmas, rollups)
+        return DokuDbWriter(self.create_database(db, overwrite), batch_size, pragmas, rollups)
+
+    def stream2db(self, db, overwrite=False, batch_size=50000, pragmas=None, sync=False,
+                  parse_workers=0, verify=False, rollups=False):
+        """Scans the directory tree straight into a sqlite database, see :py:meth:`walk`.
+
+        Parameters are those of :py:meth:`persist2db` and :py:meth:`load`.
+        """
+        with self.metrics.phase('stream2db'):
+            writer = self.open_writer(db, overwrite, batch_size, pragmas, sync, rollups)
+            for ns in self.walk(parse_workers, verify):
+                ns.persist2db(writer, recursive=False)
+                ns.release()
+            writer.close()
+        self.metrics.addRows(writer.written)
+        writer.conn.close()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,9 @@
 import logging
+import os
 from doku import Doku
+from dokucheck import DokuCheck
+from dokudedup import DokuDedup
+from dokutree import private_dir
 
 
 __author__ = 'mich'
@@ -8,13 +12,45 @@ def _doku2db(name, path):
     pass
 
 
-def doku2db(name, path):
+def doku2db(name, path, sync=False, stream=False, profile=False, memory=False, dedup=False, workers=0,
+            verify=False, check=False):
+    """Writes the `name` wiki at `path` into /tmp/doku-<name>.db, with a log file
+    and a JSON metrics report alongside, and the scan manifest and snapshot in the private
+    directory /tmp/doku-<name>.state.
+
+    :param profile: include a cProfile summary in the metrics report
+    :param memory: include tracemalloc statistics in the metrics report
+    :param dedup: also look for identical medias, see :py:class:`DokuDedup`
+    :param workers: number of threads hashing medias, and of processes verifying attic files
+    :param verify: check the integrity of attic files, see :py:class:`DokuAtticContent`
+    :param check: also look for files lacking their counterpart in another tree, see :py:class:`DokuCheck`,
+        with a JSON report in /tmp/doku-<name>.check.json; this needs the whole site, hence no `stream`
+    """
+    if check and stream:
+        raise ValueError("A consistency check needs the whole site loaded, it cannot stream")
     global basename, wiki
     basename = "/tmp/doku-" + name
     logging.basicConfig(level=logging.INFO, filename=basename + ".log", filemode="w")
+    state = private_dir(basename + ".state")
     wiki = Doku(path)
-    wiki.load()
-    wiki.persist2db(basename + ".db", overwrite=True)
+    with wiki.metrics.profiling(cpu=profile, memory=memory):
+        if stream:
+            wiki.stream2db(basename + ".db", overwrite=True, sync=sync, verify=verify, parse_workers=workers,
+                           rollups=True)
+        else:
+            wiki.load(manifest=os.path.join(state, "manifest"), snapshot=os.path.join(state, "snapshot"),
+                      verify=verify, parse_workers=workers)
+            wiki.persist2db(basename + ".db", overwrite=True, sync=sync, rollups=True)
+        if dedup:
+            duplicates = DokuDedup(wiki, workers)
+            duplicates.run()
+            duplicates.persist2db(basename + ".db")
+        if check:
+            consistency = DokuCheck(wiki)
+            consistency.run()
+            consistency.persist2db(basename + ".db")
+            consistency.dump(basename + ".check.json")
+    wiki.metrics.dump(basename + ".metrics.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+"""Exports the history of a dokuwiki site into a git repository.
+
+Page and media revisions of the attic become commits, in time order, streamed into
+a single ``git fast-import`` process: attic files are decompressed in-process, and
+authors and summaries come from the .changes fields of :py:class:`DokuRevision`.
+Replaces the former ``doku2git_step`` shell script, which forked a handful of processes
+per revision. See also: https://github.com/hoxu/dokuwiki2git
+"""
+import gzip
+import logging
+import os
+import subprocess
+from doku import Doku
+
+__author__ = 'mich'
+
+
+class DokuGitExport:
+    """Writes the revisions of a loaded :py:class:`Doku` site as a ``git fast-import`` stream.
+
+    Pages are committed as ``pages/<namespace path>/<name>.txt`` and medias as
+    ``media/<namespace path>/<name>``. A revision of mode ``D`` removes the file.
+    Revisions whose attic file is missing are skipped.
+
+    >>> import io, tempfile
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     open(os.path.join(path, 'VERSION'), 'w').write('2012-01-25 "Angua"')
+    ...     for tree in ('pages', 'media', 'attic', 'media_attic', 'meta'):
+    ...         os.makedirs(os.path.join(path, 'data', tree))
+    ...     with gzip.open(os.path.join(path, 'data', 'attic', 'start.1367320658.txt.gz'), 'wt') as f:
+    ...         f.write('Hello')
+    ...     open(os.path.join(path, 'data', 'pages', 'start.txt'), 'w').write('Hello')
+    ...     open(os.path.join(path, 'data', 'meta', 'start.changes'), 'w').write(
+    ...         "1367320658\\t1.2.3.4\\tC\\tstart\\tBob\\tcreated\\t\\n")
+    ...     wiki = Doku(path)
+    ...     wiki.load()
+    ...     stream = io.BytesIO()
+    ...     DokuGitExport(wiki).write(stream)
+    ...     following = io.BytesIO()
+    ...     DokuGitExport(wiki).write(following, parent='refs/heads/master^0')
+    18
+    5
+    5
+    40
+    >>> print(stream.getvalue().decode())
+    commit refs/heads/master
+    author Bob <bob@1.2.3.4> 1367320658 +0000
+    committer Bob <bob@1.2.3.4> 1367320658 +0000
+    data 11
+    [C] created
+    M 100644 inline pages/start.txt
+    data 5
+    Hello
+    done
+    <BLANKLINE>
+    >>> following.getvalue().split(b"\\n")[5:7]
+    [b'from refs/heads/master^0', b'M 100644 inline pages/start.txt']
+    """
+    #: Branch receiving the commits
+    ref = 'refs/heads/master'
+    #: Author of revisions without a user
+    anonymous = 'Anon'
+    #: Email domain of revisions without an ip
+    domain = 'ommitted.org'
+
+    def __init__(self, wiki, since=None):
+        """
+        :param wiki: a loaded :py:class:`Doku` site
+        :param since: only export revisions after this unix time
+        """
+        self.wiki = wiki
+        self.since = since
+        #: exported commits, deleted files and skipped revisions
+        self.counters = {'commits': 0, 'deleted': 0, 'skipped': 0, 'bytes': 0}
+
+    def revisions(self):
+        """Returns ``(time, path, source, node, i)`` for all revisions, in time order,
+        `path` being the file path in git and `source` the attic filename, split around the time."""
+        data = self.wiki.root.getDataPath()
+        events = []
+        stack = [self.wiki.root]
+        while stack:
+            ns = stack.pop()
+            nspath = ns.getPath()
+            for page in ns.pages.values():
+                path = "/".join(('pages', nspath, page.name + '.txt')).replace('//', '/')
+                source = (os.path.join(data, 'attic', nspath, page.name + '.'), '.txt.gz')
+                self.collect(events, page, path, source)
+            for media in ns.medias.values():
+                path = "/".join(('media', nspath, media.name)).replace('//', '/')
+                (base, ext) = os.path.splitext(media.name)
+                source = (os.path.join(data, 'media_attic', nspath, base + '.'), ext)
+                self.collect(events, media, path, source)
+            stack.extend(ns.children.values())
+        events.sort(key=lambda event: event[:2])
+        return events
+
+    def collect(self, events, node, path, source):
+        revisions = node.revisions
+        for i, t in enumerate(revisions.times):
+            if self.since is None or t > self.since:
+                events.append((t, path, source, node, i))
+
+    def write(self, out, parent=None):
+        """Writes the fast-import stream into binary file `out`.
+
+        :param parent: commit the first one follows, when the branch already exists;
+            deletions of files it may hold are then always written
+        """
+        exported = set()
+        for t, path, source, node, i in self.revisions():
+            revisions = node.revisions
+            fields = revisions.getFields(i) or {}
+            mode = fields.get('mode')
+            if mode == 'D':
+                if path not in exported and parent is None:
+                    self.counters['skipped'] += 1
+                    continue
+                exported.discard(path)
+                self.counters['deleted'] += 1
+                change = b"D " + path.encode() + b"\n"
+            else:
+                if revisions.sizes[i] < 0:
+                    self.counters['skipped'] += 1
+                    continue
+                try:
+                    content = self.read(source[0] + str(t) + source[1])
+                except OSError as e:
+                    logging.warning("Skipping revision %d of %s: %s", t, node.getFullname(), e)
+                    self.counters['skipped'] += 1
+                    continue
+                exported.add(path)
+                self.counters['bytes'] += len(content)
+                change = b"M 100644 inline " + path.encode() + b"\n" + self.data(content)
+            user = fields.get('user') or self.anonymous
+            email = user[:1].lower() + user[1:]
+            identity = ("%s <%s@%s> %d +0000\n" % (user, email, fields.get('ip') or self.domain, t)).encode()
+            message = "[%s] %s" % (mode or '', fields.get('summary') or '')
+            out.write(b"commit " + self.ref.encode() + b"\n"
+                      + b"author " + identity + b"committer " + identity
+                      + self.data(message.encode()))
+            if parent is not None:
+                out.write(b"from " + parent.encode() + b"\n")
+                parent = None
+            out.write(change)
+            self.counters['commits'] += 1
+        out.write(b"done\n")
+
+    @staticmethod
+    def data(content):
+        return b"data %d\n" % len(content) + content + b"\n"
+
+    @staticmethod
+    def read(source):
+        if source.endswith('.gz'):
+            with gzip.open(source, 'rb') as f:
+                return f.read()
+        with open(source, 'rb') as f:
+            return f.read()
+
+    def export(self, repository):
+        """Commits all revisions into git `repository`, created if needed,
+        on top of :py:attr:`ref` if it exists, as after a previous export."""
+        if not os.path.isdir(os.path.join(repository, '.git')):
+            subprocess.run(['git', 'init', '--quiet', repository], check=True)
+        head = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', self.ref], cwd=repository,
+                              stdout=subprocess.DEVNULL)
+        parent = self.ref + '^0' if head.returncode == 0 else None
+        with self.wiki.metrics.phase('doku2git'):
+            process = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'], cwd=repository,
+                                       stdin=subprocess.PIPE, bufsize=1024 * 1024)
+            try:
+                self.write(process.stdin, parent)
+            finally:
+                process.stdin.close()
+                if process.wait():
+                    raise subprocess.CalledProcessError(process.returncode, 'git fast-import')
+        logging.info("Git export: %s", self.counters)
+        self.wiki.metrics.addCounters('doku2git', self.counters)
+
+
+def doku2git(path, repository, since=None):
+    """Exports the history of the wiki at `path` into git `repository`."""
+    wiki = Doku(path)
+    wiki.load()
+    exporter = DokuGitExport(wiki, since)
+    exporter.export(repository)
+    return exporter
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    doku2git('/home/mich/services/sel2mers/wiki-maint',
+             '/home/mich/services/sel2mers/wiki-maint/attic2git', since=1334471317)
@@ -1,8 +1,20 @@
 import logging
+import os
 from doku import Doku
+from dokutree import private_dir
 
 __author__ = 'mich'
 
+
+def doku2org(name, path, output='-', **options):
+    """Writes an org-mode report of the `name` wiki at `path` into `output`,
+    standard output by default, see :py:meth:`Doku.report` for `options`."""
+    wiki = Doku(path)
+    # shared with doku2db, see DokuSnapshot
+    wiki.load(snapshot=os.path.join(private_dir("/tmp/doku-" + name + ".state"), "snapshot"))
+    wiki.report(output, title="%s %s" % (name, path), **options)
+
+
 if __name__ == "__main__":
 
     wikiset = [
@@ -20,7 +32,4 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
     for (name, path) in wikiset:
-        print("#+TITLE", name, path)
-        wiki = Doku(path)
-        wiki.load()
-        wiki.summary()
+        doku2org(name, path)
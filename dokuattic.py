@@ -0,0 +1,93 @@
+import bz2
+import gzip
+import hashlib
+import logging
+import zlib
+from dokupool import map_chunks
+
+__author__ = 'mich'
+
+
+class DokuAtticContent:
+    """Integrity check of a data/*attic/**/*.* file: its uncompressed size and digest.
+
+    .gz and .bz2 files are decompressed, others are read as they are.
+    A truncated or corrupt file gets a None :py:attr:`size` and :py:attr:`digest`,
+    and its :py:attr:`error`. Checks may be deferred and done in bulk by :py:func:`verify`.
+
+    >>> import os, tempfile
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     good = os.path.join(path, 'start.1367320658.txt.gz')
+    ...     with gzip.open(good, 'wb') as f:
+    ...         f.write(b'Hello')
+    ...     bad = os.path.join(path, 'start.1367320659.txt.bz2')
+    ...     open(bad, 'wb').write(bz2.compress(b'Hello')[:-4])
+    ...     content = DokuAtticContent(good)
+    ...     content.check()
+    ...     broken = DokuAtticContent(bad)
+    ...     broken.check()
+    5
+    39
+    >>> content.size, content.digest
+    (5, 'f7ff9e8b7bb2e09b70935a5d785e0cc5d9d0abf0')
+    >>> broken.size, broken.error
+    (None, 'EOFError: Compressed file ended before the end-of-stream marker was reached')
+    """
+    __slots__ = ('path', 'size', 'digest', 'error')
+    #: :py:mod:`hashlib` algorithm of :py:attr:`digest`
+    algorithm = 'sha1'
+    #: Bytes decompressed at once
+    block = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.size = None
+        self.digest = None
+        self.error = None
+
+    def isChecked(self):
+        return self.digest is not None or self.error is not None
+
+    def check(self):
+        h = hashlib.new(self.algorithm)
+        size = 0
+        if self.path.endswith('.gz'):
+            opener = gzip.open
+        elif self.path.endswith('.bz2'):
+            opener = bz2.open
+        else:
+            opener = open
+        try:
+            with opener(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(self.block), b''):
+                    size += len(block)
+                    h.update(block)
+        except (OSError, EOFError, zlib.error) as e:
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+            return
+        self.size = size
+        self.digest = h.hexdigest()
+
+
+def _check_batch(paths):
+    batch = []
+    for path in paths:
+        content = DokuAtticContent(path)
+        content.check()
+        batch.append((content.size, content.digest, content.error))
+    return batch
+
+
+def verify(contents, executor, chunksize=64):
+    """Checks all unchecked `contents` in the process pool `executor`.
+
+    Files are sent to workers by chunks of `chunksize` paths, see :py:func:`map_chunks`.
+    """
+    pending = [content for content in contents if not content.isChecked()]
+    if not pending:
+        return
+    for content, (size, digest, error) in map_chunks(executor, _check_batch, pending, chunksize):
+        content.size = size
+        content.digest = digest
+        content.error = error
+    logging.info("Checked %d attic files", len(pending))
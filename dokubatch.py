@@ -0,0 +1,173 @@
+"""Runs doku2db or doku2org over many wikis at once.
+
+Wikis are listed in a manifest file, one ``name path`` pair per line::
+
+    # name      path
+    s2m-sink    /home/mich/services/sel2mers/wiki-maint
+
+and processed concurrently, each one in its own process, so that a wiki which fails,
+hangs or exhausts memory does not take the others down::
+
+    python dokubatch.py wikis.txt --job db --workers 4 --timeout 3600 --summary audit.json
+
+Each wiki gets its own files under /tmp: doku2db ones, or ``doku-<name>.org`` for doku2org,
+plus ``doku-<name>.<job>.out`` with the output and errors of its process.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+__author__ = 'mich'
+
+#: Where per-wiki files go, followed by the wiki name
+basename = "/tmp/doku-"
+
+
+def readManifest(path):
+    """Returns the ``(name, path)`` pairs of a manifest file, skipping blank lines and comments.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+    ...     f.write("# name path\\n\\ns2m   /srv/wiki maint\\nother\\t/srv/other\\n") and None
+    ...     f.flush()
+    ...     readManifest(f.name)
+    [('s2m', '/srv/wiki maint'), ('other', '/srv/other')]
+    """
+    wikis = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError("%s:%d: expecting a name and a path, got %r" % (path, number, line))
+            wikis.append((fields[0], fields[1]))
+    return wikis
+
+
+def runJob(job, name, path):
+    """Processes one wiki, in the current process: this is what batch worker processes run."""
+    if job == 'db':
+        from doku2db import doku2db
+        doku2db(name, path)
+    elif job == 'org':
+        from doku2org import doku2org
+        logging.basicConfig(level=logging.INFO, filename=basename + name + ".org.log", filemode="w")
+        doku2org(name, path, basename + name + ".org")
+    else:
+        raise ValueError("Unknown job %s" % job)
+
+
+async def runWiki(job, name, path, timeout, slots):
+    """Runs `job` on one wiki in a child process, killed after `timeout` seconds.
+
+    Returns a result dict for the summary.
+    """
+    async with slots:
+        result = {'name': name, 'path': path, 'job': job}
+        output = basename + name + "." + job + ".out"
+        logging.info("Starting %s on %s", job, name)
+        t = time.perf_counter()
+        with open(output, "wb") as out:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), '--child', job, name, path,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdin=asyncio.subprocess.DEVNULL, stdout=out, stderr=out)
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+                result['status'] = 'ok' if process.returncode == 0 else 'failed'
+                result['returncode'] = process.returncode
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                result['status'] = 'timeout'
+        result['seconds'] = time.perf_counter() - t
+        if result['status'] == 'failed':
+            result['error'] = _lastLine(output)
+        metrics = basename + name + ".metrics.json"
+        if job == 'db' and result['status'] == 'ok' and os.path.exists(metrics):
+            with open(metrics) as f:
+                report = json.load(f)
+            result['rows'] = report.get('rows', {})
+            result['errors'] = sum(tree.get('errors', 0) for tree in report.get('trees', {}).values())
+        logging.info("Finished %s on %s: %s in %.1fs", job, name, result['status'], result['seconds'])
+        return result
+
+
+def _lastLine(path):
+    with open(path, 'rb') as f:
+        lines = f.read().decode(errors='replace').strip().splitlines()
+    return lines[-1] if lines else None
+
+
+async def runAll(wikis, job='db', workers=4, timeout=None):
+    """Runs `job` on all `wikis`, at most `workers` at a time, and returns their results in order."""
+    slots = asyncio.Semaphore(workers)
+    return await asyncio.gather(*(runWiki(job, name, path, timeout, slots) for (name, path) in wikis))
+
+
+def summarize(results):
+    """Aggregates wiki results: counts by status, total time, rows and load errors.
+
+    >>> summarize([{'name': 'a', 'status': 'ok', 'seconds': 2.0, 'rows': {'nodes': 3}, 'errors': 1},
+    ...            {'name': 'b', 'status': 'timeout', 'seconds': 5.0}])['status']
+    {'ok': 1, 'timeout': 1}
+    """
+    summary = {'wikis': len(results), 'status': {}, 'seconds': 0.0, 'rows': {}, 'errors': 0,
+               'failed': [], 'results': results}
+    for result in results:
+        status = result['status']
+        summary['status'][status] = summary['status'].get(status, 0) + 1
+        summary['seconds'] += result['seconds']
+        summary['errors'] += result.get('errors', 0)
+        for table, count in result.get('rows', {}).items():
+            summary['rows'][table] = summary['rows'].get(table, 0) + count
+        if status != 'ok':
+            summary['failed'].append(result['name'])
+    return summary
+
+
+def run(manifest, job='db', workers=4, timeout=None):
+    """Runs `job` on all wikis of `manifest` and returns the :py:func:`summarize` summary."""
+    wikis = readManifest(manifest)
+    t = time.perf_counter()
+    results = asyncio.run(runAll(wikis, job, workers, timeout))
+    summary = summarize(results)
+    summary['elapsed'] = time.perf_counter() - t
+    return summary
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == '--child':
+        (job, name, path) = argv[1:]
+        runJob(job, name, path)
+        return
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('manifest', help="file of 'name path' lines")
+    parser.add_argument('--job', choices=('db', 'org'), default='db')
+    parser.add_argument('--workers', type=int, default=4, help="wikis processed at once")
+    parser.add_argument('--timeout', type=float, help="seconds before a wiki is abandoned")
+    parser.add_argument('--summary', help="JSON summary file, default standard output")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    summary = run(args.manifest, args.job, args.workers, args.timeout)
+    report = json.dumps(summary, indent=2)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Benchmarks dokudata on synthetic dokuwiki data trees.
+
+:py:func:`generate` builds a reproducible ``data/`` tree, and :py:func:`run` times
+:py:class:`Doku` phases on it::
+
+    python dokubench.py --preset 100k --output bench.json
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+from phpserialize import serialize
+from doku import Doku
+
+__author__ = 'mich'
+
+#: Generator settings giving about 10k, 100k and 1M nodes
+PRESETS = {
+    '10k': dict(depth=2, fanout=10, pages=80, medias=10, revisions=3),
+    '100k': dict(depth=3, fanout=10, pages=80, medias=10, revisions=3),
+    '1m': dict(depth=4, fanout=10, pages=80, medias=10, revisions=2),
+}
+
+
+def generate(path, depth=2, fanout=4, pages=10, medias=2, revisions=3, seed=0):
+    """Writes a synthetic dokuwiki site under `path`.
+
+    Namespaces form a tree `depth` levels below the root, each one with `fanout` children.
+    Every namespace holds `pages` pages with `revisions` attic revisions each,
+    their .changes, .meta and .indexed files, and `medias` medias with one attic revision each.
+    The same `seed` gives the same tree.
+
+    Returns the number of nodes, pages and medias.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     generate(path, depth=1, fanout=2, pages=2, medias=1, revisions=2)
+    ...     wiki = Doku(path)
+    ...     wiki.load()
+    ...     len(wiki.root.children), len(wiki.root.pages['page0'].revisions)
+    9
+    (2, 2)
+    """
+    rnd = random.Random(seed)
+    with open(os.path.join(path, 'VERSION'), 'w') as f:
+        f.write('2012-01-25 "Angua"\n')
+    data = os.path.join(path, 'data')
+    nodes = 0
+    stack = [()]
+    while stack:
+        parts = stack.pop()
+        dirs = {tree: os.path.join(data, tree, *parts) for tree in ('pages', 'media', 'attic', 'media_attic', 'meta')}
+        for dirpath in dirs.values():
+            os.makedirs(dirpath, exist_ok=True)
+        for p in range(pages):
+            _generatePage(dirs, parts, 'page%d' % p, revisions, rnd)
+        for m in range(medias):
+            _generateMedia(dirs, 'image%d.png' % m, rnd)
+        nodes += pages + medias
+        if len(parts) < depth:
+            stack.extend(parts + ('ns%d' % n,) for n in range(fanout))
+    return nodes
+
+
+def _generatePage(dirs, parts, name, revisions, rnd):
+    pageid = ":".join(parts + (name,))
+    text = "====== %s ======\n%s\n" % (pageid, "lorem ipsum " * rnd.randint(1, 100))
+    with open(os.path.join(dirs['pages'], name + '.txt'), 'w') as f:
+        f.write(text)
+    date = 1300000000 + rnd.randint(0, 10 ** 7)
+    changes = []
+    for r in range(revisions):
+        date += rnd.randint(1, 10 ** 5)
+        with gzip.open(os.path.join(dirs['attic'], '%s.%d.txt.gz' % (name, date)), 'wt') as f:
+            f.write(text[:rnd.randint(1, len(text))])
+        user = 'user%d' % rnd.randint(0, 20)
+        changes.append("\t".join((str(date), '10.0.0.%d' % rnd.randint(1, 254), 'E' if r else 'C',
+                                  pageid, user, 'edit %d' % r, '')))
+    with open(os.path.join(dirs['meta'], name + '.changes'), 'w') as f:
+        f.write("\n".join(changes) + "\n")
+    with open(os.path.join(dirs['meta'], name + '.indexed'), 'w') as f:
+        f.write("7")
+    with open(os.path.join(dirs['meta'], name + '.meta'), 'wb') as f:
+        f.write(serialize({
+            'current': {'title': pageid, 'creator': 'user0', 'last_change': {'date': date, 'user': user}},
+            'persistent': {'creator': 'user0'}}))
+
+
+def _generateMedia(dirs, name, rnd):
+    content = bytes(rnd.getrandbits(8) for i in range(rnd.randint(16, 512)))
+    with open(os.path.join(dirs['media'], name), 'wb') as f:
+        f.write(content)
+    (base, ext) = os.path.splitext(name)
+    date = 1300000000 + rnd.randint(0, 10 ** 7)
+    with open(os.path.join(dirs['media_attic'], '%s.%d%s' % (base, date, ext)), 'wb') as f:
+        f.write(content[::-1])
+
+
+def run(path, db, **options):
+    """Times :py:meth:`Doku.load`, :py:meth:`Doku.summary` and :py:meth:`Doku.persist2db`
+    on the site at `path`, `options` being passed to :py:meth:`Doku.load`.
+
+    Returns a dict of phase timings, in seconds, and counts.
+    """
+    results = {'path': path, 'options': options, 'phases': {}}
+    phases = results['phases']
+    t = time.perf_counter()
+    wiki = Doku(path)
+    wiki.load(**options)
+    phases['load'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        wiki.summary()
+    phases['summary'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    wiki.persist2db(db, overwrite=True)
+    phases['persist2db'] = time.perf_counter() - t
+
+    conn = sqlite3.connect(db)
+    for table in ('ns', 'nodes', 'revisions'):
+        results[table] = conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0]
+    conn.close()
+    results['metrics'] = wiki.metrics.report()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/tmp/dokubench', help="synthetic site directory")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='10k')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help="rebuild the site even if it exists")
+    parser.add_argument('--workers', type=int, default=0, help="scanning threads")
+    parser.add_argument('--parse-workers', type=int, default=0, help="changelog parsing processes")
+    parser.add_argument('--output', help="JSON results file, default standard output")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    path = os.path.join(args.path, args.preset)
+    results = {'preset': args.preset, 'settings': PRESETS[args.preset], 'seed': args.seed}
+    if args.regenerate or not os.path.exists(os.path.join(path, 'VERSION')):
+        os.makedirs(path, exist_ok=True)
+        t = time.perf_counter()
+        results['generated_nodes'] = generate(path, seed=args.seed, **PRESETS[args.preset])
+        results['generate'] = time.perf_counter() - t
+    results.update(run(path, path + '.db', workers=args.workers, parse_workers=args.parse_workers))
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
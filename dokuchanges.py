@@ -0,0 +1,116 @@
+import logging
+import mmap
+import os
+from array import array
+from dokupool import map_chunks
+
+__author__ = 'mich'
+
+#: .changes fields following the date
+FIELDS = ('ip', 'mode', 'name', 'user', 'summary', 'extra', 'flags')
+
+
+class DokuChangelog:
+    """Contents of a data/meta/**/*.changes file, as columns.
+
+    :py:attr:`times` holds revision dates, and :py:attr:`fields` one list per
+    :py:data:`FIELDS` entry, None marking a missing value. Parsing may be deferred
+    and done in bulk by :py:func:`ingest`.
+
+    Files are split into lines and fields as bytes, and only kept fields are decoded,
+    once per distinct value: ips, modes, ids and users repeat a lot in a changelog.
+    :py:attr:`size` is in bytes.
+
+    >>> log = DokuChangelog(None)
+    >>> log.parse("1367320658\\t78.243.149.12\\tE\\tcr:27-01-2013\\trockyroad\\tnotes\\t\\n"
+    ...           "1367320600\\t78.243.149.12\\tC\\tcr:27-01-2013")
+    >>> list(log.times), log.fields[1], log.fields[3]
+    ([1367320658, 1367320600], ['E', 'C'], ['rockyroad', None])
+    """
+    __slots__ = ('path', 'size', 'times', 'fields', 'errors')
+    #: Size from which files are mapped rather than read
+    mmapSize = 1024 * 1024
+
+    def __init__(self, path, size=None):
+        """
+        :param size: size of the file, when a scan already stat'ed it
+        """
+        self.path = path
+        self.size = size
+        self.times = None
+        self.fields = None
+        #: number of lines which could not be parsed
+        self.errors = 0
+
+    def isParsed(self):
+        return self.times is not None
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            size = self.size if self.size is not None else os.fstat(f.fileno()).st_size
+            if size < self.mmapSize:
+                self.parseLines(f.read().splitlines(), size)
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # readline only stops at \n: split each chunk again so lone \r
+                # ends a line here just as it does for smaller files.
+                self.parseLines((part for chunk in iter(m.readline, b"") for part in chunk.splitlines()), size)
+
+    def parse(self, data):
+        """Parses changelog contents, as bytes or text."""
+        if isinstance(data, str):
+            data = data.encode()
+        self.parseLines(data.splitlines(), len(data))
+
+    def parseLines(self, lines, size):
+        self.size = size
+        self.times = array('q')
+        self.fields = [[] for name in FIELDS]
+        self.errors = 0
+        width = len(FIELDS)
+        decoded = {}
+        for line in lines:
+            values = line.split(b"\t", width + 1)
+            if not values[0].isdigit():
+                logging.error("Skipping changelog line without a date: %r", line.decode(errors='replace'))
+                self.errors += 1
+                continue
+            self.times.append(int(values[0]))
+            values = values[1:width + 1]
+            for column, value in zip(self.fields, values):
+                text = decoded.get(value)
+                if text is None:
+                    text = decoded[value] = value.decode(errors='replace')
+                column.append(text)
+            for column in self.fields[len(values):]:
+                column.append(None)
+
+    def __len__(self):
+        return len(self.times)
+
+
+def _parse_batch(files):
+    batch = []
+    for path, size in files:
+        log = DokuChangelog(path, size)
+        log.read()
+        batch.append((log.size, log.times, log.fields, log.errors))
+    return batch
+
+
+def ingest(changelogs, executor, chunksize=64):
+    """Parses all unparsed `changelogs` in the process pool `executor`.
+
+    Files are sent to workers by chunks of `chunksize` paths, with their size, see
+    :py:func:`map_chunks`, and come back as columnar batches.
+    """
+    pending = [log for log in changelogs if not log.isParsed()]
+    if not pending:
+        return
+    batches = map_chunks(executor, _parse_batch, pending, chunksize, key=lambda log: (log.path, log.size))
+    for log, (size, times, fields, errors) in batches:
+        log.size = size
+        log.times = times
+        log.fields = fields
+        log.errors = errors
+    logging.info("Parsed %d changelogs", len(pending))
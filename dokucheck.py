@@ -0,0 +1,179 @@
+"""Finds files of one data tree which lack their counterpart in another.
+
+The namespace graph of a loaded site is walked once, collecting the keys found in
+each tree, then every class of anomaly is a set difference between two of them.
+"""
+import json
+from dokudb import replace_rows, node_ids, revision_ids
+from dokunode import DokuRevisions
+
+__author__ = 'mich'
+
+
+class DokuCheck:
+    """Consistency check of a loaded :py:class:`Doku` site.
+
+    Nodes are keyed by namespace full name and name, revisions by node key and date,
+    like the natural keys of database rows. Anomalies are listed by class,
+    see :py:attr:`classes`, in key order.
+
+    >>> import os, tempfile
+    >>> from doku import Doku
+    >>> changes = "".join("%d\\t10.0.0.1\\t%s\\tstart\\tbob\\t\\t\\n" % entry
+    ...                   for entry in ((1367320500, 'C'), (1367320550, 'E'), (1367320600, 'D'), (1367320658, 'E')))
+    >>> files = {'VERSION': '2013-05-10', 'data/pages/start.txt': 'hello', 'data/meta/start.changes': changes,
+    ...          'data/attic/start.1367320500.txt.gz': '', 'data/attic/start.1367320700.txt.gz': '',
+    ...          'data/meta/gone.meta': 'N;', 'data/attic/gone.1367320500.txt.gz': '',
+    ...          'data/media/logo.png': '', 'data/media_attic/old.1367320600.png': ''}
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     for relpath, text in files.items():
+    ...         os.makedirs(os.path.dirname(os.path.join(path, relpath)), exist_ok=True)
+    ...         with open(os.path.join(path, relpath), 'w') as f:
+    ...             n = f.write(text)
+    ...     wiki = Doku(path)
+    ...     wiki.load()
+    ...     check = DokuCheck(wiki)
+    ...     counts = check.run()
+    >>> {name: count for (name, count) in counts.items() if count}
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'meta_without_page': 1, 'attic_without_page': 1, 'attic_without_changelog': 2, 'changelog_without_attic': 1,
+     'media_attic_without_media': 1, 'page_without_indexed': 1}
+    >>> check.anomalies['attic_without_changelog'], check.anomalies['changelog_without_attic']
+    ([((':', 'gone'), 1367320500), ((':', 'start'), 1367320700)], [((':', 'start'), 1367320550)])
+    """
+    #: Anomaly classes, with the type of their nodes and their description
+    classes = {
+        'meta_without_page': ('DokuPage', "meta files of a page which does not exist"),
+        'attic_without_page': ('DokuPage', "attic revisions of a page which does not exist"),
+        'attic_without_changelog': ('DokuPage', "attic revisions without a .changes entry"),
+        'changelog_without_attic': ('DokuPage', "changes entries without an attic revision, but deletions "
+                                                "and the last one of an existing page, which is the page itself"),
+        'media_attic_without_media': ('DokuMedia', "media_attic revisions of a media which does not exist"),
+        'page_without_indexed': ('DokuPage', "pages without an .indexed file"),
+    }
+    #: Index of the mode among revision fields: deletions, of mode ``D``, have no attic file
+    MODE = DokuRevisions.FIELDS.index('mode')
+    #: Table receiving anomalies, created in existing databases as needed
+    ddl = """
+    CREATE TABLE IF NOT EXISTS anomalies (
+            id integer primary key autoincrement,
+            class varchar(32) not null,
+            node_id integer references nodes(id),
+            revision_id integer references revisions(id),
+            fullname varchar(255) not null,
+            name varchar(255) not null,
+            time integer
+            );
+    """
+
+    def __init__(self, wiki):
+        """
+        :param wiki: the loaded :py:class:`Doku` site
+        """
+        self.wiki = wiki
+        #: sorted keys of each anomaly class, once :py:meth:`run`
+        self.anomalies = None
+
+    def keys(self):
+        """Returns the sets of keys found in each tree, walking the namespace graph once."""
+        keys = {name: set() for name in ('pages', 'meta', 'indexed', 'attic', 'changes', 'current',
+                                         'medias', 'media_attic')}
+        (pages, meta, indexed, attic, changes, current, medias, media_attic) = keys.values()
+        stack = [self.wiki.root]
+        while stack:
+            ns = stack.pop()
+            for name, page in ns.pages.items():
+                key = (ns.fullname, name)
+                if not page.isMissing():
+                    pages.add(key)
+                if (page.sz_meta, page.sz_changes, page.sz_indexed) != (None, None, None):
+                    meta.add(key)
+                if page.sz_indexed is not None:
+                    indexed.add(key)
+                revisions = page.revisions
+                logged = [(t, revisions.getValue(self.MODE, i)) for (i, t) in enumerate(revisions.times)
+                          if revisions.hasFields(i)]
+                attic.update((key, t) for (t, size) in zip(revisions.times, revisions.sizes) if size >= 0)
+                changes.update((key, t) for (t, mode) in logged if mode != 'D')
+                if logged and key in pages:
+                    current.add((key, max(logged)[0]))
+            for name, media in ns.medias.items():
+                key = (ns.fullname, name)
+                if not media.isMissing():
+                    medias.add(key)
+                revisions = media.revisions
+                media_attic.update((key, t) for (t, size) in zip(revisions.times, revisions.sizes) if size >= 0)
+            stack.extend(ns.children.values())
+        return keys
+
+    def run(self):
+        """Finds all anomalies, see :py:attr:`anomalies`, and returns their count by class."""
+        with self.wiki.metrics.phase('check'):
+            keys = self.keys()
+            anomalies = {
+                'meta_without_page': keys['meta'] - keys['pages'],
+                'attic_without_page': {rev for rev in keys['attic'] if rev[0] not in keys['pages']},
+                'attic_without_changelog': keys['attic'] - keys['changes'],
+                'changelog_without_attic': keys['changes'] - keys['attic'] - keys['current'],
+                'media_attic_without_media': {rev for rev in keys['media_attic'] if rev[0] not in keys['medias']},
+                'page_without_indexed': keys['pages'] - keys['indexed'],
+            }
+            self.anomalies = {name: sorted(found) for (name, found) in anomalies.items()}
+        counts = {name: len(found) for (name, found) in self.anomalies.items()}
+        self.wiki.metrics.addCounters('check', counts)
+        return counts
+
+    def rows(self):
+        """Yields ``(class, fullname, name, time)`` tuples, time None for node anomalies."""
+        for name, found in self.anomalies.items():
+            for key in found:
+                if isinstance(key[1], int):
+                    ((fullname, nodename), time) = key
+                else:
+                    ((fullname, nodename), time) = (key, None)
+                yield (name, fullname, nodename, time)
+
+    def report(self):
+        """Returns the anomalies as a JSON serializable dict: counts and lists by class."""
+        report = {'classes': {}}
+        for name, (type, description) in self.classes.items():
+            report['classes'][name] = {'type': type, 'description': description,
+                                       'count': len(self.anomalies[name]), 'anomalies': []}
+        for (name, fullname, nodename, time) in self.rows():
+            entry = {'fullname': fullname, 'name': nodename}
+            if time is not None:
+                entry['time'] = time
+            report['classes'][name]['anomalies'].append(entry)
+        return report
+
+    def dump(self, path):
+        """Writes the :py:meth:`report` into JSON file `path`."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+    def persist2db(self, db):
+        """Writes :py:attr:`anomalies` into the anomalies table of existing database `db`,
+        replacing its previous contents.
+
+        Rows refer to the node and revision of the anomaly, when the database has them.
+        """
+        count = replace_rows(db, self.ddl, 'anomalies',
+                             ('class', 'node_id', 'revision_id', 'fullname', 'name', 'time'), self.tableRows)
+        self.wiki.metrics.addRows({'anomalies': count})
+
+    def tableRows(self, c):
+        """Returns the rows of the anomalies table, looking up ids through cursor `c`."""
+        nodes = node_ids(c)
+        revisions = revision_ids(c)
+        rows = []
+        for (name, fullname, nodename, time) in self.rows():
+            node_id = nodes.get((self.classes[name][0], fullname, nodename))
+            rev_id = revisions.get((node_id, str(time))) if time is not None else None
+            rows.append((name, node_id, rev_id, fullname, nodename, time))
+        return rows
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
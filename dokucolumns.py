@@ -0,0 +1,306 @@
+"""Columnar export of the dokudata tables, for analytics over many wikis.
+
+The ns, nodes and revisions tables are written column by column, in row groups of
+a fixed number of rows, as the namespace graph is walked, so that memory use does
+not depend on the size of the site. Revision times are integers, and repetitive
+string columns, such as revision users, ips and modes, are dictionary encoded.
+
+Two formats are available:
+
+``parquet``
+    one ``<table>.parquet`` file per table, written with :py:mod:`pyarrow`, when installed.
+``npy``
+    one NumPy ``.npy`` file per column, ``<table>.<column>.npy``, which ``numpy.load``
+    reads directly, or maps with ``mmap_mode='r'``. Dictionary encoded columns hold
+    int32 codes, -1 for no value, into the ``dictionaries`` of ``schema.json``.
+    String columns are split into ``<table>.<column>.offsets.npy``, n + 1 int64 offsets,
+    and ``<table>.<column>.data.npy``, their UTF-8 bytes. This format needs no third
+    party module to be written.
+
+Integer columns hold :py:attr:`DokuFile.MISSING` for no value, in both formats.
+"""
+import json
+import os
+import sys
+from array import array
+from dokudb import DokuDbWriter
+from dokunode import DokuFile
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__author__ = 'mich'
+
+
+class DokuColumnWriter:
+    """Abstract base class of columnar writers, with the interface of :py:class:`DokuDbWriter`,
+    so that :py:meth:`DokuNamespace.persist2db` writes them like a database.
+
+    Rows are buffered per table, and written as a row group when :py:attr:`batch_size` are buffered.
+    """
+    #: Columns of each table, id first
+    columns = {table: ('id',) + columns for (table, columns) in DokuDbWriter.columns.items()}
+    #: Kind of the columns which are not integers: ``dict`` for dictionary encoded strings,
+    #: ``str`` for other strings, ``bytes`` for binary values
+    kinds = {
+        ('ns', 'fullname'): 'str',
+        ('nodes', 'type'): 'dict',
+        ('nodes', 'name'): 'str',
+        ('nodes', 'meta'): 'bytes',
+        ('revisions', 'mode'): 'dict',
+        ('revisions', 'user'): 'dict',
+        ('revisions', 'name'): 'str',
+        ('revisions', 'ip'): 'dict',
+        ('revisions', 'summary'): 'str',
+        ('revisions', 'extra'): 'dict',
+        ('revisions', 'digest'): 'str',
+    }
+
+    def __init__(self, path, batch_size=50000):
+        """
+        :param path: directory receiving the files, created as needed
+        :param batch_size: number of rows of a row group
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = {table: [] for table in self.columns}
+        self.ids = dict.fromkeys(self.columns, 0)
+        #: dictionary encoded values, with their code, per column
+        self.dictionaries = {key: {} for (key, kind) in self.kinds.items() if kind == 'dict'}
+        #: row counts of the row groups written, per table
+        self.groups = {table: [] for table in self.columns}
+        #: rows written so far, per table
+        self.written = dict.fromkeys(self.columns, 0)
+
+    def kind(self, table, column):
+        return self.kinds.get((table, column), 'int')
+
+    def add(self, table, *values):
+        """Buffers a row for `table` and returns its id."""
+        self.ids[table] += 1
+        row_id = self.ids[table]
+        rows = self.rows[table]
+        rows.append((row_id,) + values)
+        if len(rows) >= self.batch_size:
+            self.flushTable(table)
+        return row_id
+
+    def addNamespace(self, fullname):
+        return self.add('ns', fullname)
+
+    def addNode(self, type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta):
+        return self.add('nodes', type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta)
+
+    def addRevision(self, node_id, time, size, mode=None, user=None, name=None, ip=None,
+                    summary=None, extra=None, raw_size=None, digest=None):
+        return self.add('revisions', node_id, int(time), size, mode, user, name, ip, summary, extra,
+                        raw_size, digest)
+
+    def encode(self, table, column, values):
+        """Returns the `values` of a column as integers, codes or strings, according to its kind."""
+        kind = self.kind(table, column)
+        if kind == 'int':
+            return array('q', [DokuFile.MISSING if v is None else v for v in values])
+        if kind == 'dict':
+            codes = self.dictionaries[(table, column)]
+            return array('i', [-1 if v is None else codes.setdefault(v, len(codes)) for v in values])
+        return values
+
+    def flush(self):
+        for table in self.columns:
+            self.flushTable(table)
+
+    def flushTable(self, table):
+        """Writes buffered rows of `table` as a row group."""
+        rows = self.rows[table]
+        if not rows:
+            return
+        columns = {column: self.encode(table, column, values)
+                   for (column, values) in zip(self.columns[table], zip(*rows))}
+        self.writeGroup(table, columns)
+        self.groups[table].append(len(rows))
+        self.written[table] += len(rows)
+        rows.clear()
+
+    def writeGroup(self, table, columns):
+        raise NotImplementedError
+
+    def close(self):
+        """Writes remaining rows, then completes the files."""
+        self.flush()
+
+
+class DokuNpyFile:
+    """A one-dimensional ``.npy`` file, written by appending buffers, its length being set by :py:meth:`close`."""
+    #: Bytes of the header, padded so that it can be rewritten in place with the final shape
+    header = 128
+
+    def __init__(self, path, descr):
+        """
+        :param descr: NumPy type descriptor, such as ``<i8``
+        """
+        self.descr = descr
+        self.count = 0
+        self.f = open(path, 'wb')
+        self.f.write(self.encodeHeader())
+
+    def encodeHeader(self):
+        text = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (self.descr, self.count)
+        text = text.ljust(self.header - 10 - 1) + "\n"
+        return b'\x93NUMPY\x01\x00' + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+    def append(self, data, count):
+        self.f.write(data)
+        self.count += count
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(self.encodeHeader())
+        self.f.close()
+
+
+class DokuNpyWriter(DokuColumnWriter):
+    """Columnar writer of ``.npy`` files, see :py:mod:`dokucolumns`.
+
+    >>> import tempfile
+    >>> from dokunamespace import DokuRoot
+    >>> class Site:
+    ...     path = ''
+    >>> root = DokuRoot(Site)
+    >>> for name in ('start', 'syntax'):
+    ...     page = root.addPage(name, 120)
+    ...     for date in ('1367320600', '1367320658'):
+    ...         rev = page.addRevision(date, 60)
+    ...     page.setChanges("1367320600\\t1.2.3.4\\tC\\t%s\\tann\\n" % name)
+    >>> rev = root.addMedia('logo.png', 300).addRevision('1367320700', 300)
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     writer = DokuNpyWriter(path, batch_size=2)
+    ...     root.persist2db(writer)
+    ...     writer.close()
+    ...     with open(os.path.join(path, 'schema.json')) as f:
+    ...         schema = json.load(f)
+    ...     with open(os.path.join(path, 'revisions.time.npy'), 'rb') as f:
+    ...         header = f.read(DokuNpyFile.header)
+    ...         times = array('q', f.read())
+    ...     with open(os.path.join(path, 'revisions.user.npy'), 'rb') as f:
+    ...         users = array('i', f.read()[DokuNpyFile.header:])
+    >>> schema['tables']['revisions']['groups'], schema['tables']['revisions']['columns']['user']
+    ([2, 2, 1], 'dict')
+    >>> header[:8], b"'shape': (5,)" in header, times.tolist()
+    (b'\\x93NUMPY\\x01\\x00', True, [1367320600, 1367320658, 1367320600, 1367320658, 1367320700])
+    >>> users.tolist(), schema['dictionaries']['revisions.user']
+    ([0, -1, 0, -1, -1], ['ann'])
+    >>> schema['dictionaries']['nodes.type']
+    ['DokuPage', 'DokuMedia']
+    """
+    #: NumPy descriptors of encoded columns
+    descrs = {'q': 'i8', 'i': 'i4'}
+
+    def __init__(self, path, batch_size=50000):
+        super().__init__(path, batch_size)
+        self.order = '<' if sys.byteorder == 'little' else '>'
+        self.files = {}
+        self.offsets = {}
+
+    def file(self, name, descr):
+        if name not in self.files:
+            self.files[name] = DokuNpyFile(os.path.join(self.path, name + '.npy'), descr)
+        return self.files[name]
+
+    def writeGroup(self, table, columns):
+        for column, values in columns.items():
+            name = table + '.' + column
+            if isinstance(values, array):
+                self.file(name, self.order + self.descrs[values.typecode]).append(values.tobytes(), len(values))
+                continue
+            offsets = self.file(name + '.offsets', self.order + 'i8')
+            data = self.file(name + '.data', '|u1')
+            if not offsets.count:
+                offsets.append(array('q', [0]).tobytes(), 1)
+            ends = array('q')
+            end = data.count
+            chunks = []
+            for value in values:
+                if value is None:
+                    value = b''
+                elif isinstance(value, str):
+                    value = value.encode()
+                chunks.append(value)
+                end += len(value)
+                ends.append(end)
+            offsets.append(ends.tobytes(), len(ends))
+            data.append(b''.join(chunks), end - data.count)
+
+    def close(self):
+        super().close()
+        for f in self.files.values():
+            f.close()
+        schema = {
+            'tables': {table: {'rows': self.written[table], 'groups': self.groups[table],
+                               'columns': {column: self.kind(table, column) for column in columns}}
+                       for (table, columns) in self.columns.items()},
+            'dictionaries': {table + '.' + column: list(codes)
+                             for ((table, column), codes) in self.dictionaries.items()},
+        }
+        with open(os.path.join(self.path, 'schema.json'), 'w') as f:
+            json.dump(schema, f, indent=2)
+            f.write("\n")
+
+
+class DokuParquetWriter(DokuColumnWriter):
+    """Columnar writer of Parquet files, with :py:mod:`pyarrow`, see :py:mod:`dokucolumns`.
+
+    Each row group of the writer is a Parquet row group. Dictionary encoded columns are
+    Arrow dictionary arrays, read back as such: Arrow encodes each row group on its own,
+    so that its dictionary only holds the values the group uses.
+    """
+
+    def __init__(self, path, batch_size=50000, compression='snappy'):
+        if pyarrow is None:
+            raise ImportError("Parquet export needs pyarrow")
+        super().__init__(path, batch_size)
+        self.compression = compression
+        self.types = {'int': pyarrow.int64(), 'dict': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+                      'str': pyarrow.string(), 'bytes': pyarrow.binary()}
+        self.schemas = {table: pyarrow.schema([(column, self.types[self.kind(table, column)]) for column in columns])
+                        for (table, columns) in self.columns.items()}
+        self.writers = {}
+
+    def encode(self, table, column, values):
+        if self.kind(table, column) == 'dict':
+            return values
+        return super().encode(table, column, values)
+
+    def writeGroup(self, table, columns):
+        arrays = []
+        for column, values in columns.items():
+            kind = self.kind(table, column)
+            if kind == 'dict':
+                arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, self.types[kind]))
+        if table not in self.writers:
+            self.writers[table] = pyarrow.parquet.ParquetWriter(
+                os.path.join(self.path, table + '.parquet'), self.schemas[table], compression=self.compression)
+        self.writers[table].write_table(pyarrow.Table.from_arrays(arrays, schema=self.schemas[table]))
+
+    def close(self):
+        super().close()
+        for writer in self.writers.values():
+            writer.close()
+
+
+#: Columnar writers, by format name
+formats = {'parquet': DokuParquetWriter, 'npy': DokuNpyWriter}
+
+
+def open_columns(path, format=None, batch_size=50000):
+    """Returns a columnar writer into directory `path`, for `format`,
+    by default Parquet if :py:mod:`pyarrow` is installed, NumPy files otherwise."""
+    if format is None:
+        format = 'parquet' if pyarrow is not None else 'npy'
+    return formats[format](path, batch_size)
@@ -0,0 +1,330 @@
+import logging
+import sqlite3
+from dokunode import DokuFile
+
+__author__ = 'mich'
+
+
+def node_ids(c):
+    """Returns the ids of nodes of the database of cursor `c`, by type, namespace full name and name."""
+    return {(type, fullname, name): node_id for (node_id, type, fullname, name) in c.execute(
+        "SELECT N.id, N.type, ns.fullname, N.name FROM nodes N INNER JOIN ns ON ns.id = N.ns_id")}
+
+
+def revision_ids(c):
+    """Returns the ids of revisions of the database of cursor `c`, by node id and time."""
+    return {(node_id, time): rev_id for (rev_id, node_id, time) in c.execute(
+        "SELECT id, node_id, time FROM revisions")}
+
+
+def replace_rows(db, ddl, table, columns, rows):
+    """Replaces the contents of an auxiliary `table` of existing database `db`, such as findings
+    about the site, and returns the number of rows written.
+
+    The table is created by script `ddl` as needed. `rows` is called with a cursor on the database,
+    for instance to look up the :py:func:`node_ids` and :py:func:`revision_ids` rows refer to,
+    and returns the rows, holding `columns`.
+
+    >>> import os, tempfile
+    >>> ddl = "CREATE TABLE IF NOT EXISTS notes (id integer primary key, note text);"
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     db = os.path.join(path, 'doku.db')
+    ...     replace_rows(db, ddl, 'notes', ('note',), lambda c: [('old',), ('older',)])
+    ...     replace_rows(db, ddl, 'notes', ('note',), lambda c: [('new',)])
+    ...     sqlite3.connect(db).execute("SELECT note FROM notes").fetchall()
+    2
+    1
+    [('new',)]
+    """
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    c.executescript(ddl)
+    rows = rows(c)
+    c.execute("DELETE FROM %s" % table)
+    c.executemany("INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join("?" * len(columns))),
+                  rows)
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+class DokuDbWriter:
+    """Bulk writer for the dokudata sqlite database.
+
+    Row ids are assigned here rather than by sqlite, so that rows can be buffered per table
+    and flushed with ``executemany`` in large batches, without a ``lastrowid`` round trip
+    for each of them. All rows are written within a single transaction, committed by
+    :py:meth:`close`.
+
+    >>> import sqlite3
+    >>> conn = sqlite3.connect(":memory:")
+    >>> with open('dokudata.ddl') as f:
+    ...     conn.executescript(f.read()) and None
+    >>> writer = DokuDbWriter(conn, batch_size=2, rollups=True)
+    >>> ns_id = writer.addNamespace(":")
+    >>> node_id = writer.addNode('DokuPage', ns_id, 'start', 12, 3, 1, -1, b'N;')
+    >>> for date in ('1367320658', '1367320659'):
+    ...     rev_id = writer.addRevision(node_id, date, 10)
+    >>> writer.close()
+    >>> conn.execute("select node_id, time, size from revisions").fetchall()
+    [(1, '1367320658', 10), (1, '1367320659', 10)]
+    >>> conn.execute("select * from node_stats").fetchall()
+    [(1, 2, 1367320658, 1367320659, 20)]
+
+    Indexes are only created by :py:meth:`close`, once rows are loaded, which is
+    cheaper than maintaining them row by row.
+    """
+    #: PRAGMA settings used during the load, trading durability for speed:
+    #: a failed load is simply done again.
+    pragmas = {
+        'journal_mode': 'MEMORY',
+        'synchronous': 'OFF',
+        'cache_size': -65536,
+    }
+    #: Indexes created after the load, by name
+    indexes = {
+        'nodes_ns': ('nodes', ('ns_id', 'type', 'name')),
+        'nodes_name': ('nodes', ('name',)),
+        'revisions_node': ('revisions', ('node_id', 'time')),
+        'revisions_time': ('revisions', ('time',)),
+        'revisions_user': ('revisions', ('user', 'time')),
+    }
+    #: Statements rebuilding the materialized rollups of revisions per node and per namespace:
+    #: revision count, first and last revision times, attic bytes, and node bytes per namespace.
+    #: They are run one by one, within the transaction of the load.
+    rollups = """
+    DROP TABLE IF EXISTS node_stats;
+    CREATE TABLE node_stats AS
+    SELECT N.id AS node_id, count(R.id) AS rev_count,
+      min(cast(R.time AS integer)) AS first_time, max(cast(R.time AS integer)) AS last_time,
+      coalesce(sum(CASE WHEN R.size >= 0 THEN R.size END), 0) AS attic_bytes
+    FROM nodes N
+    LEFT JOIN revisions R ON R.node_id = N.id
+    GROUP BY N.id;
+    CREATE UNIQUE INDEX node_stats_node ON node_stats (node_id);
+
+    DROP TABLE IF EXISTS ns_stats;
+    CREATE TABLE ns_stats AS
+    SELECT N.ns_id AS ns_id, count(*) AS nodes,
+      sum(N.type = 'DokuPage') AS pages, sum(N.type = 'DokuMedia') AS medias,
+      coalesce(sum(CASE WHEN N.size >= 0 THEN N.size END), 0) AS bytes,
+      sum(S.rev_count) AS rev_count, min(S.first_time) AS first_time, max(S.last_time) AS last_time,
+      sum(S.attic_bytes) AS attic_bytes
+    FROM nodes N
+    INNER JOIN node_stats S ON S.node_id = N.id
+    GROUP BY N.ns_id;
+    CREATE UNIQUE INDEX ns_stats_ns ON ns_stats (ns_id);
+    """
+    #: Columns of each table, id excepted
+    columns = {
+        'ns': ('fullname',),
+        'nodes': ('type', 'ns_id', 'name', 'size', 'sz_changes', 'sz_indexed', 'sz_meta', 'meta'),
+        'revisions': ('node_id', 'time', 'size', 'mode', 'user', 'name', 'ip', 'summary', 'extra',
+                      'raw_size', 'digest'),
+    }
+
+    def __init__(self, conn, batch_size=50000, pragmas=None, rollups=False):
+        """
+        :param conn: an open sqlite3 connection to a database with dokudata tables
+        :param batch_size: number of buffered rows triggering a flush
+        :param pragmas: PRAGMA settings overriding :py:attr:`pragmas`
+        :param rollups: rebuild the node_stats and ns_stats tables, see :py:attr:`rollups`
+        """
+        self.conn = conn
+        self.batch_size = batch_size
+        self.withRollups = rollups
+        self.c = conn.cursor()
+        settings = dict(self.pragmas)
+        settings.update(pragmas or {})
+        for name, value in settings.items():
+            self.c.execute("PRAGMA %s = %s" % (name, value))
+        self.rows = {}
+        self.ids = {}
+        self.sql = {}
+        for table, columns in self.columns.items():
+            self.rows[table] = []
+            self.ids[table] = self.c.execute("SELECT coalesce(max(id), 0) FROM %s" % table).fetchone()[0]
+            self.sql[table] = "INSERT INTO %s (id, %s) VALUES (?%s)" % (
+                table, ", ".join(columns), ", ?" * len(columns))
+        self.count = 0
+        #: rows written so far, per table
+        self.written = dict.fromkeys(self.columns, 0)
+
+    def add(self, table, *values):
+        """Buffers a row for `table` and returns its id."""
+        self.ids[table] += 1
+        row_id = self.ids[table]
+        self.rows[table].append((row_id,) + values)
+        self.count += 1
+        if self.count >= self.batch_size:
+            self.flush()
+        return row_id
+
+    def addNamespace(self, fullname):
+        return self.add('ns', fullname)
+
+    def addNode(self, type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta):
+        return self.add('nodes', type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta)
+
+    def addRevision(self, node_id, time, size, mode=None, user=None, name=None, ip=None,
+                    summary=None, extra=None, raw_size=None, digest=None):
+        return self.add('revisions', node_id, time, size, mode, user, name, ip, summary, extra, raw_size, digest)
+
+    def flush(self):
+        """Writes all buffered rows, parent tables first."""
+        for table in self.columns:
+            rows = self.rows[table]
+            if rows:
+                logging.debug("Flushing %d rows into %s", len(rows), table)
+                self.c.executemany(self.sql[table], rows)
+                self.written[table] += len(rows)
+                rows.clear()
+        self.count = 0
+
+    def close(self):
+        """Flushes remaining rows, builds indexes and rollups, and commits the transaction."""
+        self.flush()
+        self.createIndexes()
+        if self.withRollups:
+            logging.debug("Building rollups")
+            if not self.conn.in_transaction:
+                self.c.execute("BEGIN")
+            for statement in self.rollups.split(";"):
+                if statement.strip():
+                    self.c.execute(statement)
+        self.conn.commit()
+
+    def createIndexes(self):
+        for name, (table, columns) in self.indexes.items():
+            logging.debug("Creating index %s", name)
+            self.c.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (name, table, ", ".join(columns)))
+
+
+class DokuDbSync(DokuDbWriter):
+    """Writer bringing an existing dokudata database up to date, instead of filling a new one.
+
+    Existing rows are matched by natural keys: namespace full name, node type and name
+    within its namespace, revision time within its node. New rows are inserted,
+    rows whose values changed are updated, and nodes or revisions not seen again are
+    marked as vanished with a :py:attr:`DokuFile.MISSING` size. Row ids are kept,
+    so that queries and views over the database stay valid.
+
+    A sync may be restricted to some namespaces, for instance those where files changed:
+    only their nodes and revisions are then matched, and marked as vanished if not seen again.
+
+    >>> import sqlite3
+    >>> conn = sqlite3.connect(":memory:")
+    >>> with open('dokudata.ddl') as f:
+    ...     conn.executescript(f.read()) and None
+    >>> writer = DokuDbWriter(conn)
+    >>> for fullname in (':', ':ns:'):
+    ...     node_id = writer.addNode('DokuPage', writer.addNamespace(fullname), 'start', 12, 3, 1, -1, b'N;')
+    >>> writer.close()
+    >>> sync = DokuDbSync(conn, namespaces=[':ns:'])
+    >>> node_id = sync.addNode('DokuPage', sync.addNamespace(':ns:'), 'other', 5, 3, 1, -1, b'N;')
+    >>> sync.close()
+    >>> conn.execute("select ns_id, name, size from nodes").fetchall()
+    [(1, 'start', 12), (2, 'start', -1), (2, 'other', 5)]
+    """
+    #: PRAGMA settings of the sync: unlike a new database, an existing one must survive a crash
+    #: in the middle of it, so writes are synced, and the journal is left as the database has it,
+    #: on disk. Write-ahead logging sticks to the database file once set, so it is only used
+    #: when asked for, with ``pragmas={'journal_mode': 'WAL'}``
+    pragmas = {
+        'synchronous': 'FULL',
+        'cache_size': -65536,
+    }
+    #: Natural key columns of each table, leading its :py:attr:`columns`
+    keys = {'ns': ('fullname',), 'nodes': ('type', 'ns_id', 'name'), 'revisions': ('node_id', 'time')}
+    #: Columns added since the first database layout, with their type
+    added = {'revisions': (('raw_size', 'integer'), ('digest', 'char(40)'))}
+
+    def __init__(self, conn, batch_size=50000, pragmas=None, rollups=False, namespaces=None):
+        """
+        :param namespaces: full names of the namespaces synced, all by default
+        """
+        c = conn.cursor()
+        for table, columns in self.added.items():
+            existing = {row[1] for row in c.execute("PRAGMA table_info(%s)" % table)}
+            for column, type in columns:
+                if column not in existing:
+                    c.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, type))
+        super().__init__(conn, batch_size, pragmas, rollups)
+        self.known = {
+            'ns': {fullname: row_id for (row_id, fullname) in self.c.execute("SELECT id, fullname FROM ns")}}
+        (nodes, revisions) = ("", "")
+        if namespaces is not None:
+            self.c.execute("CREATE TEMP TABLE IF NOT EXISTS sync_ns (id integer PRIMARY KEY)")
+            self.c.execute("DELETE FROM sync_ns")
+            self.c.executemany("INSERT OR IGNORE INTO sync_ns VALUES (?)",
+                               [(self.known['ns'][fullname],) for fullname in namespaces
+                                if fullname in self.known['ns']])
+            nodes = " WHERE ns_id IN (SELECT id FROM sync_ns)"
+            revisions = " WHERE node_id IN (SELECT id FROM nodes" + nodes + ")"
+        self.known['nodes'] = {row[1:4]: (row[0], row[4:]) for row in self.c.execute(
+            "SELECT id, type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta FROM nodes" + nodes)}
+        self.known['revisions'] = {row[1:3]: (row[0], row[3:]) for row in self.c.execute(
+            "SELECT id, node_id, time, size, mode, user, name, ip, summary, extra, raw_size, digest "
+            "FROM revisions" + revisions)}
+        self.seen = {'nodes': set(), 'revisions': set()}
+        self.updates = {}
+        for table in ('nodes', 'revisions'):
+            self.updates[table] = []
+            self.sql['update_' + table] = "UPDATE %s SET %s WHERE id = ?" % (
+                table, ", ".join(c + " = ?" for c in self.columns[table][len(self.keys[table]):]))
+        self.inserted = dict.fromkeys(self.columns, 0)
+        self.updated = dict.fromkeys(self.updates, 0)
+
+    def sync(self, table, key, values):
+        """Inserts or updates a row of `table`, as needed, and returns its id."""
+        if key not in self.known[table]:
+            self.inserted[table] += 1
+            return self.add(table, *(key + values))
+        (row_id, old) = self.known[table][key]
+        self.seen[table].add(row_id)
+        if old != values:
+            self.updated[table] += 1
+            self.updates[table].append(values + (row_id,))
+            self.count += 1
+            if self.count >= self.batch_size:
+                self.flush()
+        return row_id
+
+    def addNamespace(self, fullname):
+        if fullname in self.known['ns']:
+            return self.known['ns'][fullname]
+        self.inserted['ns'] += 1
+        return self.add('ns', fullname)
+
+    def addNode(self, type, ns_id, name, size, sz_changes, sz_indexed, sz_meta, meta):
+        return self.sync('nodes', (type, ns_id, name), (size, sz_changes, sz_indexed, sz_meta, meta))
+
+    def addRevision(self, node_id, time, size, mode=None, user=None, name=None, ip=None,
+                    summary=None, extra=None, raw_size=None, digest=None):
+        key = (node_id, time)
+        if digest is None and raw_size is None and key in self.known['revisions']:
+            # keep the last verification of the file
+            (raw_size, digest) = self.known['revisions'][key][1][-2:]
+        return self.sync('revisions', key, (size, mode, user, name, ip, summary, extra, raw_size, digest))
+
+    def flush(self):
+        super().flush()
+        for table, rows in self.updates.items():
+            if rows:
+                logging.debug("Updating %d rows of %s", len(rows), table)
+                self.c.executemany(self.sql['update_' + table], rows)
+                self.written[table] += len(rows)
+                rows.clear()
+
+    def close(self):
+        """Marks vanished nodes and revisions, then flushes and commits."""
+        vanished = {}
+        for table in ('nodes', 'revisions'):
+            rows = [(DokuFile.MISSING, row_id) for (key, (row_id, old)) in self.known[table].items()
+                    if row_id not in self.seen[table] and old[0] != DokuFile.MISSING]
+            self.c.executemany("UPDATE %s SET size = ? WHERE id = ?" % table, rows)
+            vanished[table] = len(rows)
+            self.written[table] += len(rows)
+        super().close()
+        logging.info("Database sync: inserted %s, updated %s, vanished %s",
+                     self.inserted, self.updated, vanished)
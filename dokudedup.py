@@ -0,0 +1,253 @@
+"""Finds identical medias and media revisions, whatever their names and namespaces.
+
+Candidates are narrowed in three steps, so that most files are never read:
+
+1. files are grouped by size, only sizes shared by several files are kept;
+2. within each size, files are grouped by a partial hash of their first and last
+   :py:attr:`DokuDedup.chunk` bytes;
+3. only files sharing a partial hash are fully hashed, through :py:mod:`mmap`.
+
+Hard links to the same inode are only hashed once, and do not count as wasted space.
+"""
+import hashlib
+import logging
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dokudb import replace_rows, node_ids, revision_ids
+from dokunamespace import DokuNamespace
+from dokutree import DokuMediaTree, DokuMediaAttic
+
+__author__ = 'mich'
+
+
+class DokuDedup:
+    """Duplicate detection over the media and media_attic trees of a :py:class:`Doku` site.
+
+    Each file is identified by its namespace full name, media name and revision date,
+    None for a current media, which are the natural keys of the database rows.
+
+    >>> import tempfile
+    >>> from doku import Doku
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     open(os.path.join(path, 'VERSION'), 'w').write('2012-01-25 "Angua"')
+    ...     for (relpath, content) in (('media/logo.png', b'png' * 100), ('media/ns/copy.png', b'png' * 100),
+    ...                                ('media/ns/other.png', b'gif' * 100), ('media_attic/logo.1367320658.png', b'png' * 100)):
+    ...         os.makedirs(os.path.dirname(os.path.join(path, 'data', relpath)), exist_ok=True)
+    ...         open(os.path.join(path, 'data', relpath), 'wb').write(content)
+    ...     dedup = DokuDedup(Doku(path))
+    ...     [(size, [key for (key, relpath) in files]) for (digest, size, files) in dedup.run()]
+    18
+    300
+    300
+    300
+    300
+    [(300, [(':', 'logo.png', None), (':ns:', 'copy.png', None), (':', 'logo.png', '1367320658')])]
+    >>> [dedup.counters[name] for name in ('candidates', 'partial', 'hashed', 'wasted')]
+    [4, 4, 0, 600]
+    """
+    #: Trees holding medias
+    trees = (DokuMediaTree, DokuMediaAttic)
+    #: Bytes read at each end of a file for its partial hash
+    chunk = 64 * 1024
+    #: Bytes hashed at once by the full hash
+    block = 1024 * 1024
+    #: :py:mod:`hashlib` algorithm
+    algorithm = 'blake2b'
+    #: Table receiving duplicates, created in existing databases as needed
+    ddl = """
+    CREATE TABLE IF NOT EXISTS duplicates (
+            id integer primary key autoincrement,
+            digest char(128) not null,
+            size integer not null,
+            node_id integer references nodes(id),
+            revision_id integer references revisions(id),
+            path varchar(255) not null
+            );
+    """
+
+    def __init__(self, wiki, workers=0):
+        """
+        :param wiki: the :py:class:`Doku` site, which needs not be loaded
+        :param workers: number of hashing threads, 0 to hash in the calling thread
+        """
+        self.wiki = wiki
+        self.workers = workers
+        #: ``(digest, size, files)`` for each set of identical files, `files` being
+        #: a list of ``((fullname, name, rev), relpath)``, largest waste first
+        self.groups = []
+        #: scanned files, files sharing their size, partially and fully hashed ones, bytes read,
+        #: groups of duplicates and bytes they waste, files which could not be read
+        self.counters = dict.fromkeys(('files', 'candidates', 'partial', 'hashed', 'bytes', 'groups',
+                                       'wasted', 'errors'), 0)
+
+    def scan(self):
+        """Returns ``(key, abspath, stat)`` for each media and media revision."""
+        root = self.wiki.root
+        files = []
+        for cls in self.trees:
+            tree = cls(root)
+            dirpath = root.getPathFor(tree.treename)
+            if not os.path.isdir(dirpath):
+                continue
+            for parts, entries in tree.scan(dirpath):
+                fullname = DokuNamespace.sep + "".join(part + DokuNamespace.sep for part in parts)
+                for entry, abspath, st, data, names in entries:
+                    if cls is DokuMediaTree:
+                        key = (fullname, entry, None)
+                    else:
+                        (name, rev, ext) = names
+                        key = (fullname, name + ext, rev)
+                    files.append((key, abspath, st))
+        self.counters['files'] += len(files)
+        return files
+
+    def run(self):
+        """Finds all sets of identical files, see :py:attr:`groups`."""
+        metrics = self.wiki.metrics
+        with metrics.phase('dedup.scan'):
+            files = self.scan()
+        bysize = self.group(files, lambda f: f[2].st_size)
+        # empty files are all alike, and waste nothing
+        candidates = [group for (size, group) in bysize.items() if size and len(group) > 1]
+        self.counters['candidates'] = sum(len(group) for group in candidates)
+
+        with metrics.phase('dedup.partial'):
+            partial = self.hashAll(candidates, self.hashPartial)
+        complete = []
+        incomplete = []
+        for group in candidates:
+            for digest, same in self.group(group, lambda f: partial.get(self.inode(f))).items():
+                if digest is None or len(same) < 2:
+                    continue
+                if same[0][2].st_size <= 2 * self.chunk:
+                    complete.append((digest, same))
+                else:
+                    incomplete.append(same)
+        self.counters['partial'] = len(partial)
+
+        with metrics.phase('dedup.full'):
+            full = self.hashAll(incomplete, self.hashFull)
+        for group in incomplete:
+            for digest, same in self.group(group, lambda f: full.get(self.inode(f))).items():
+                if digest is not None and len(same) > 1:
+                    complete.append((digest, same))
+        self.counters['hashed'] = len(full)
+
+        self.groups = []
+        for digest, same in complete:
+            size = same[0][2].st_size
+            inodes = len({self.inode(f) for f in same})
+            if inodes < 2:
+                continue
+            self.counters['groups'] += 1
+            self.counters['wasted'] += size * (inodes - 1)
+            self.groups.append((digest, size, [(key, self.relpath(abspath)) for (key, abspath, st) in same]))
+        self.groups.sort(key=lambda g: g[1] * len(g[2]), reverse=True)
+        logging.info("Media dedup: %s", self.counters)
+        metrics.addCounters('dedup', self.counters)
+        return self.groups
+
+    @staticmethod
+    def group(files, key):
+        groups = {}
+        for f in files:
+            groups.setdefault(key(f), []).append(f)
+        return groups
+
+    @staticmethod
+    def inode(f):
+        st = f[2]
+        return (st.st_dev, st.st_ino)
+
+    def relpath(self, abspath):
+        return os.path.relpath(abspath, self.wiki.root.getDataPath())
+
+    def hashAll(self, groups, hash):
+        """Hashes each distinct inode of `groups` once, returning a dict of digests by inode."""
+        todo = {}
+        for group in groups:
+            for f in group:
+                todo.setdefault(self.inode(f), (f[1], f[2].st_size))
+        inodes = list(todo)
+        jobs = [todo[inode] for inode in inodes]
+        if self.workers:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(lambda job: self.hashFile(hash, *job), jobs))
+        else:
+            results = [self.hashFile(hash, *job) for job in jobs]
+        digests = {}
+        for inode, (digest, read) in zip(inodes, results):
+            digests[inode] = digest
+            self.counters['bytes'] += read
+            if digest is None:
+                self.counters['errors'] += 1
+        return digests
+
+    def hashFile(self, hash, abspath, size):
+        """Returns the digest of a file and the number of bytes read, None and 0 when it cannot be read."""
+        try:
+            return hash(abspath, size)
+        except OSError as e:
+            logging.warning("Cannot hash %s: %s", abspath, e)
+            return (None, 0)
+
+    def hashPartial(self, abspath, size):
+        """Hashes the first and last :py:attr:`chunk` bytes of a file, hence all of a small one."""
+        h = hashlib.new(self.algorithm)
+        with open(abspath, 'rb') as f:
+            if size <= 2 * self.chunk:
+                data = f.read()
+            else:
+                data = f.read(self.chunk)
+                f.seek(-self.chunk, os.SEEK_END)
+                data += f.read(self.chunk)
+        h.update(data)
+        return (h.hexdigest(), len(data))
+
+    def hashFull(self, abspath, size):
+        """Hashes a whole file, mapped in memory and fed to the hash by :py:attr:`block`.
+
+        A file emptied since it was scanned cannot be mapped, its digest is that of no bytes.
+
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as f:
+        ...     DokuDedup(None).hashFull(f.name, 4096)[1]
+        0
+        """
+        h = hashlib.new(self.algorithm)
+        with open(abspath, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return (h.hexdigest(), 0)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+                for offset in range(0, len(m), self.block):
+                    h.update(view[offset:offset + self.block])
+                read = len(m)
+        return (h.hexdigest(), read)
+
+    def persist2db(self, db):
+        """Writes :py:attr:`groups` into the duplicates table of existing database `db`,
+        replacing its previous contents.
+
+        Rows refer to the media node and revision of the file, when the database has them.
+        """
+        count = replace_rows(db, self.ddl, 'duplicates', ('digest', 'size', 'node_id', 'revision_id', 'path'),
+                             self.rows)
+        self.wiki.metrics.addRows({'duplicates': count})
+
+    def rows(self, c):
+        """Returns the rows of the duplicates table, looking up ids through cursor `c`."""
+        nodes = node_ids(c)
+        revisions = revision_ids(c)
+        rows = []
+        for digest, size, files in self.groups:
+            for (fullname, name, rev), relpath in files:
+                node_id = nodes.get(('DokuMedia', fullname, name))
+                rev_id = revisions.get((node_id, rev)) if rev else None
+                rows.append((digest, size, node_id, rev_id, relpath))
+        return rows
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,132 @@
+import bisect
+from array import array
+from dokunode import DokuRevision, DokuRevisions
+
+__author__ = 'mich'
+
+
+class DokuIndex:
+    """Secondary indexes over the namespace graph of a loaded :py:class:`Doku` site.
+
+    Built once by :py:meth:`Doku.getIndex`, it answers lookups by page id, revision
+    range queries by time and user, and node queries by size, without walking the graph.
+    Ids are dokuwiki ids, such as ``wiki:syntax``, without the leading separator.
+
+    >>> from dokunamespace import DokuRoot
+    >>> class Site:
+    ...     path = ''
+    >>> root = DokuRoot(Site)
+    >>> page = root.getNamespace('wiki').addPage('syntax', 1200)
+    >>> for date in ('1367320658', '1367320600'):
+    ...     rev = page.addRevision(date, 600)
+    >>> page.setChanges("1367320600\\t1.2.3.4\\tC\\tsyntax\\tann\\n1367320658\\t1.2.3.4\\tE\\tsyntax\\tbob\\n")
+    >>> media = root.addMedia('logo.png', 300)
+    >>> rev = root.addPage('gone', -1).addRevision('1367320700', 80)
+    >>> index = DokuIndex(root)
+    >>> index.getPage('wiki:syntax').name, index.getMedia('logo.png').ns.fullname
+    ('syntax', ':')
+    >>> [rev.date for rev in index.getRevisions()], sorted(index.getUsers())
+    (['1367320600', '1367320658', '1367320700'], ['ann', 'bob'])
+    >>> [rev.date for rev in index.getRevisions(user='bob')], [rev.date for rev in index.getRevisions(start=1367320650)]
+    (['1367320658'], ['1367320658', '1367320700'])
+    >>> [node.name for node in index.getNodes(max_size=512)], index.getSizeBuckets()
+    (['logo.png'], {9: 1, 11: 1})
+    >>> [node.name for node in index.getMissing()]
+    ['gone']
+    """
+    #: Position of the user field in revision fields
+    USER = DokuRevisions.FIELDS.index('user')
+
+    def __init__(self, root):
+        #: pages and medias by id
+        self.pages = {}
+        self.medias = {}
+        #: nodes whose page or media file is missing
+        self.missing = []
+        #: all revisions, as node and index lists parallel to their sorted times
+        self.times = array('q')
+        self.revisions = []
+        #: revisions of each user, likewise
+        self.users = {}
+        #: all nodes, parallel to their sorted sizes
+        self.sizes = array('q')
+        self.nodes = []
+        self.build(root)
+
+    def build(self, root):
+        revisions = []
+        nodes = []
+        strings = root.strings
+        stack = [root]
+        while stack:
+            ns = stack.pop()
+            prefix = ns.fullname[len(ns.sep):]
+            for index, children in ((self.pages, ns.pages), (self.medias, ns.medias)):
+                for name, node in children.items():
+                    index[prefix + name] = node
+                    nodes.append((node.size, node))
+                    if node.isMissing():
+                        self.missing.append(node)
+                    revs = node.revisions
+                    users = revs.fields[self.USER] if revs.fields is not None else None
+                    for i, t in enumerate(revs.times):
+                        revisions.append((t, strings[users[i]] if users else None, node, i))
+            stack.extend(ns.children.values())
+        revisions.sort(key=lambda r: r[0])
+        self.times = array('q', [r[0] for r in revisions])
+        self.revisions = [(node, i) for (t, user, node, i) in revisions]
+        for t, user, node, i in revisions:
+            if user not in self.users:
+                self.users[user] = (array('q'), [])
+            (times, refs) = self.users[user]
+            times.append(t)
+            refs.append((node, i))
+        nodes.sort(key=lambda n: n[0])
+        self.sizes = array('q', [size for (size, node) in nodes])
+        self.nodes = [node for (size, node) in nodes]
+
+    def getPage(self, id):
+        return self.pages.get(id)
+
+    def getMedia(self, id):
+        return self.medias.get(id)
+
+    def getRevisions(self, user=None, start=None, end=None):
+        """Returns revisions from `start` to `end` times included, in time order,
+        only those of `user` when given."""
+        if user is None:
+            (times, refs) = (self.times, self.revisions)
+        elif user in self.users:
+            (times, refs) = self.users[user]
+        else:
+            return []
+        lo = 0 if start is None else bisect.bisect_left(times, start)
+        hi = len(times) if end is None else bisect.bisect_right(times, end)
+        return [DokuRevision(node, i) for (node, i) in refs[lo:hi]]
+
+    def getUsers(self):
+        return [user for user in self.users if user is not None]
+
+    def getNodes(self, min_size=0, max_size=None):
+        """Returns nodes from `min_size` to `max_size` bytes included, smallest first."""
+        lo = bisect.bisect_left(self.sizes, min_size)
+        hi = len(self.sizes) if max_size is None else bisect.bisect_right(self.sizes, max_size)
+        return self.nodes[lo:hi]
+
+    def getSizeBuckets(self):
+        """Returns the number of nodes by power-of-two size bucket: bucket `b` counts
+        sizes from ``2 ** (b - 1)`` to ``2 ** b - 1``, bucket 0 empty files."""
+        buckets = {}
+        if not self.sizes:
+            return buckets
+        lo = bisect.bisect_left(self.sizes, 0)
+        for bucket in range(self.sizes[-1].bit_length() + 1):
+            hi = bisect.bisect_left(self.sizes, 1 << bucket)
+            if hi > lo:
+                buckets[bucket] = hi - lo
+            lo = hi
+        return buckets
+
+    def getMissing(self):
+        """Returns nodes which have history or meta data, but no page or media file."""
+        return self.missing
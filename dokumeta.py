@@ -0,0 +1,93 @@
+from phpserialize import unserialize
+
+__author__ = 'mich'
+
+#: Meta entries extracted by the ``select`` backend, as key paths
+KEYS = (('current', 'title'), ('current', 'creator'), ('current', 'last_change'))
+
+
+def unserialize_full(data):
+    """Builds the whole meta structure with :py:mod:`phpserialize`."""
+    return unserialize(data, decode_strings=True)
+
+
+def unserialize_select(data, keys=KEYS):
+    """Builds only the meta entries at `keys` paths, skipping over everything else.
+
+    Unwanted values are stepped over using the lengths serialization provides,
+    without building them.
+
+    >>> data = (b'a:2:{s:7:"current";a:3:{s:5:"title";s:5:"Hello";s:4:"date";a:1:{s:7:"created";i:1;}'
+    ...         b's:7:"creator";s:3:"Bob";}s:10:"persistent";a:0:{}}')
+    >>> unserialize_select(data)
+    {'current': {'title': 'Hello', 'creator': 'Bob'}}
+    >>> unserialize_select(data, (('current', 'date'),))
+    {'current': {'date': {'created': 1}}}
+    >>> unserialize_select(b'a:2:{s:4:"data";O:8:"stdClass":1:{s:1:"a";i:1;}s:7:"current";a:1:{s:5:"title";s:2:"Hi";}}')
+    {'current': {'title': 'Hi'}}
+    """
+    trie = {}
+    for path in keys:
+        node = trie
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = None
+    value, pos = _select(data, 0, trie)
+    return value
+
+
+#: Available meta parsers, by name
+backends = {
+    'phpserialize': unserialize_full,
+    'select': unserialize_select,
+}
+
+
+def _select(data, pos, trie):
+    if trie is None:
+        end = _skip(data, pos)
+        return unserialize(data[pos:end], decode_strings=True), end
+    if data[pos:pos + 1] != b'a':
+        return None, _skip(data, pos)
+    colon = data.index(b':', pos + 2)
+    count = int(data[pos + 2:colon])
+    pos = colon + 2
+    result = {}
+    for i in range(count):
+        end = _skip(data, pos)
+        key = _key(data, pos, end)
+        if key in trie:
+            result[key], pos = _select(data, end, trie[key])
+        else:
+            pos = _skip(data, end)
+    return result, pos + 1
+
+
+def _key(data, pos, end):
+    if data[pos:pos + 1] == b's':
+        colon = data.index(b':', pos + 2)
+        return data[colon + 2:end - 2].decode()
+    return int(data[pos + 2:end - 1])
+
+
+def _skip(data, pos):
+    """Returns the position following the serialized value starting at `pos`."""
+    kind = data[pos:pos + 1]
+    if kind == b'N':
+        return pos + 2
+    if kind in (b'i', b'b', b'd'):
+        return data.index(b';', pos) + 1
+    if kind == b's':
+        colon = data.index(b':', pos + 2)
+        return colon + int(data[pos + 2:colon]) + 4
+    if kind in (b'a', b'O'):
+        if kind == b'O':
+            colon = data.index(b':', pos + 2)
+            pos = colon + int(data[pos + 2:colon]) + 2
+        colon = data.index(b':', pos + 2)
+        count = int(data[pos + 2:colon])
+        pos = colon + 2
+        for i in range(2 * count):
+            pos = _skip(data, pos)
+        return pos + 1
+    raise ValueError("Unexpected serialized value at %d: %r" % (pos, data[pos:pos + 16]))
@@ -0,0 +1,113 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import time
+import tracemalloc
+
+__author__ = 'mich'
+
+
+class DokuMetrics:
+    """Where time and memory go while loading and persisting a :py:class:`Doku` site.
+
+    It gathers per-tree counters, phase timers, rows written per table, and optionally
+    the results of a :py:mod:`cProfile` and :py:mod:`tracemalloc` session.
+
+    >>> metrics = DokuMetrics()
+    >>> with metrics.phase('persist2db'):
+    ...     metrics.addRows({'nodes': 10})
+    >>> metrics.addTree('pages', {'dirs': 1, 'files': 10, 'bytes': 1000, 'errors': 0})
+    >>> report = metrics.report()
+    >>> report['rows']['nodes'], report['trees']['pages']['files']
+    (10, 10)
+    """
+    #: Number of functions and allocation sites listed in profiling reports
+    top = 25
+
+    def __init__(self):
+        self.trees = {}
+        self.phases = {}
+        self.rows = {}
+        self.counters = {}
+        self.profile = None
+        self.memory = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block, adding its duration to phase `name`."""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - t
+
+    def addTree(self, treename, counters):
+        self._add(self.trees.setdefault(treename, {}), counters)
+
+    def addCounters(self, name, counters):
+        """Adds the counters of some other piece of work, such as :py:class:`DokuDedup`."""
+        self._add(self.counters.setdefault(name, {}), counters)
+
+    @staticmethod
+    def _add(totals, counters):
+        for key, value in counters.items():
+            totals[key] = totals.get(key, 0) + value
+
+    def addRows(self, rows):
+        for table, count in rows.items():
+            self.rows[table] = self.rows.get(table, 0) + count
+
+    @contextlib.contextmanager
+    def profiling(self, cpu=True, memory=False):
+        """Runs the enclosed block under :py:mod:`cProfile` and/or :py:mod:`tracemalloc`,
+        keeping their top entries for :py:meth:`report`."""
+        profiler = cProfile.Profile() if cpu else None
+        if memory:
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profile = self._profileTop(profiler)
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                (current, peak) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.memory = {
+                    'current': current,
+                    'peak': peak,
+                    'top': [{'site': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                            for stat in snapshot.statistics('lineno')[:self.top]],
+                }
+
+    def _profileTop(self, profiler):
+        stats = pstats.Stats(profiler)
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [{'function': "%s:%d(%s)" % func, 'calls': nc, 'tottime': tt, 'cumtime': ct}
+                for (func, (cc, nc, tt, ct, callers)) in entries]
+
+    def report(self):
+        """Returns all metrics as a JSON-serializable dict, with rates per second."""
+        report = {'phases': dict(self.phases), 'trees': self.trees, 'rows': dict(self.rows)}
+        persist = self.phases.get('persist2db') or self.phases.get('stream2db')
+        if persist:
+            report['rows_per_second'] = {table: count / persist for (table, count) in self.rows.items()}
+        load = self.phases.get('load')
+        if load:
+            report['files_per_second'] = {tree: counters.get('files', 0) / load
+                                          for (tree, counters) in self.trees.items()}
+        if self.counters:
+            report['counters'] = self.counters
+        if self.profile is not None:
+            report['profile'] = self.profile
+        if self.memory is not None:
+            report['memory'] = self.memory
+        return report
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
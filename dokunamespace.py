@@ -1,7 +1,9 @@
 import logging
 import os
 import re
-from dokunode import DokuPage, DokuMedia, DokuFile
+import sys
+from dokunode import DokuPage, DokuMedia, DokuFile, DokuStrings
+from dokureport import DokuReport
 
 
 __author__ = 'mich'
@@ -27,6 +29,8 @@ class DokuNamespace:
         self.medias = {}
         self.children = {}
         self.fullname = (self.parent.getFullName() + self.name + DokuNamespace.sep)
+        #: intern table of revision fields, that of the site
+        self.strings = parent.strings
 
     def getPath(self):
         return os.path.join(self.parent.getPath(),self.name)
@@ -70,30 +74,33 @@ class DokuNamespace:
             self.children[name] = ns
         return ns
 
+    def getNamespacePath(self, parts):
+        """Returns the descendant namespace reached through the `parts` sequence of names,
+        creating missing ones on the way.
+        """
+        ns = self
+        for name in parts:
+            ns = ns.getNamespace(name)
+        return ns
+
 
     def summary(self):
-        print("* Namespace: " + self.fullname)
-        print("** pages: %d" % (len(self.pages)))
-        for k, page in self.pages.items():
-            page.summary()
-        if len(self.medias):
-            print("** medias: %d" % (len(self.medias)))
-            for k, media in self.medias.items():
-                media.summary()
-        for k, ns in self.children.items():
-            ns.summary()
-
-    def persist2db(self, c):
-        c.execute('''
-        INSERT INTO ns (fullname) VALUES (?)
-        ''', (self.fullname,))
-        ns_id = c.lastrowid
+        DokuReport().write(self, sys.stdout)
+
+    def persist2db(self, writer, recursive=True):
+        ns_id = writer.addNamespace(self.fullname)
         for k, page in self.pages.items():
-            page.persist2db(c, ns_id)
+            page.persist2db(writer, ns_id)
         for k, media in self.medias.items():
-            media.persist2db(c, ns_id)
-        for k, ns in self.children.items():
-            ns.persist2db(c)
+            media.persist2db(writer, ns_id)
+        if recursive:
+            for k, ns in self.children.items():
+                ns.persist2db(writer)
+
+    def release(self):
+        """Forgets pages and medias of this namespace, once they have been processed."""
+        self.pages = {}
+        self.medias = {}
 
     def getDoku(self):
         return self.parent.getDoku()
@@ -108,6 +115,7 @@ class DokuRoot(DokuNamespace):
         self.pages = {}
         self.medias = {}
         self.children = {}
+        self.strings = DokuStrings()
 
     def getDataPath(self):
         return self.data
@@ -115,6 +123,12 @@ class DokuRoot(DokuNamespace):
     def getDoku(self):
         return self.doku
 
+    def __getstate__(self):
+        # the site is not part of a snapshot, see DokuSnapshot
+        state = dict(self.__dict__)
+        del state['doku']
+        return state
+
     def getPath(self):
         return ''
 
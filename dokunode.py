@@ -1,5 +1,8 @@
 import logging
-from phpserialize import serialize, unserialize
+from array import array
+from phpserialize import serialize
+import dokumeta
+from dokuchanges import DokuChangelog, FIELDS
 
 __author__ = 'mich'
 
@@ -8,6 +11,7 @@ class DokuFile(object):
     """
     Represents a data/**/*.* file.
     """
+    __slots__ = ('size',)
     #: special negative size value to mark a missing file
     MISSING = -1
 
@@ -25,6 +29,7 @@ class DokuNodeFile(DokuFile):
     is associated to a `DokuNode` (`DokuPage` or `DokuMedia`)
     and is further characterized by a timestamp (:py:attr:`date`).
     """
+    __slots__ = ('node',)
 
     def __init__(self, node, size):
         super().__init__(size)
@@ -35,152 +40,444 @@ class DokuRevision(DokuNodeFile):
     Represents a data/*attic/**/*.*  file.
     It is associated to a `DokuNode` (`DokuPage` or `DokuMedia`)
     and is further characterized by a timestamp (:py:attr:`date`).
+
+    Revision data is held by the :py:class:`DokuRevisions` of the node:
+    this is only a view on its `i` th entry.
     """
+    __slots__ = ('i',)
 
-    def __init__(self, node, date, size):
-        super().__init__(node, size)
-        self.date = date
-        self.meta = None
-
-    def persist2db(self, c, node_id):
-        if self.meta:
-            c.execute('''
-                INSERT INTO revisions (node_id, time, size,
-                        mode, user, name, ip, summary, extra)
-                        VALUES (?, ?, ?,  ?, ?, ?, ?, ?, ?)
-                ''', (node_id, self.date, self.size,
-                      self.meta['mode'],
-                      self.meta['user'],
-                      self.meta['name'],
-                      self.meta['ip'],
-                      self.meta['summary'],
-                      self.meta['extra']
-            ))
+    def __init__(self, node, i):
+        self.node = node
+        self.i = i
+
+    @property
+    def date(self):
+        return str(self.node.revisions.times[self.i])
+
+    @property
+    def size(self):
+        return self.node.revisions.sizes[self.i]
+
+    @size.setter
+    def size(self, size):
+        self.node.revisions.sizes[self.i] = size
+
+    @property
+    def meta(self):
+        return self.node.revisions.getFields(self.i)
+
+    @property
+    def content(self):
+        """Uncompressed size and digest of the revision file, as checked by :py:class:`DokuAtticContent`."""
+        return self.node.revisions.getContent(self.i)
+
+    def setContent(self, raw_size, digest):
+        self.node.revisions.setContent(self.i, raw_size, digest)
+
+    def persist2db(self, writer, node_id):
+        revisions = self.node.revisions
+        (raw_size, digest) = revisions.getContent(self.i)
+        if revisions.hasFields(self.i):
+            writer.addRevision(node_id, self.date, self.size,
+                               *revisions.getColumns(self.i, ('mode', 'user', 'name', 'ip', 'summary', 'extra')),
+                               raw_size=raw_size, digest=digest)
         else:
-            c.execute('''
-                INSERT INTO revisions (node_id, time, size)
-                VALUES (?, ?, ?)
-                ''', (node_id, self.date, self.size))
+            writer.addRevision(node_id, self.date, self.size, raw_size=raw_size, digest=digest)
 
     def setMetaFields(self, dict):
         """
         example: {'mode': 'E', 'user': 'rockyroad', 'name': 'cr:27-01-2013',
                 'ip': '78.243.149.12', 'extra': '', 'summary': 'Ajout des notes de Jacqueline'}
         """
-        self.meta = dict
-        logging.debug("  Revision fields: %s", repr(self.meta))
-
-class DokuIndexed(DokuNodeFile):
-    """
-    Represents a data/meta/**/*.indexed  file.
-    """
-    pass
+        self.node.revisions.setFields(self.i, dict)
+        logging.debug("  Revision fields: %r", dict)
 
 
-class DokuChanges(DokuNodeFile):
-    """
-    Represents a data/meta/**/*.changes  file.
-    """
-    pass
+class DokuStrings:
+    """Intern table for the repetitive strings of revision fields: modes, users ...
 
+    Each site has its own, held by its :py:class:`DokuRoot`, so that it goes away with the site.
 
-class DokuMeta(DokuNodeFile):
+    >>> strings = DokuStrings()
+    >>> strings.code('rockyroad'), strings.code('E'), strings.code('rockyroad')
+    (1, 2, 1)
+    >>> strings[1], strings[0]
+    ('rockyroad', None)
     """
-    Represents a data/meta/**/*.meta  file.
+    __slots__ = ('strings', 'codes')
+
+    def __init__(self):
+        self.strings = [None]
+        self.codes = {None: 0}
+
+    def code(self, s):
+        code = self.codes.get(s)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(s)
+            self.codes[s] = code
+        return code
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+
+class DokuRevisions:
+    """Revisions of a node, stored as a struct of arrays rather than as one object per revision.
+
+    Times and sizes are plain integer arrays. Each .changes field of :py:attr:`INTERNED`
+    is an array of codes into the :py:attr:`strings` table of the site, 0 meaning no value;
+    these have few distinct values, so that the table stays small however many pages
+    are loaded. Other fields, such as ips, page names and summaries, are kept as lists
+    of values, None meaning no value.
+    Revisions are accessed by date, like a dict, through :py:class:`DokuRevision` views.
+    Uncompressed sizes and digests of revision files, only known once verified,
+    are kept in two more lists, :py:attr:`contents`.
+
+    >>> revisions = DokuRevisions(None)
+    >>> revisions.add('1367320658', 42)
+    0
+    >>> revisions.setFields(0, {'mode': 'E', 'user': 'rockyroad'})
+    >>> '1367320658' in revisions, len(revisions)
+    (True, 1)
+    >>> revisions.getFields(0)
+    {'mode': 'E', 'user': 'rockyroad'}
+    >>> revisions.setFields(0, {'mode': 'E', 'name': 'start', 'summary': ''})
+    >>> revisions.getFields(0), revisions.fields[FIELDS.index('name')]
+    ({'mode': 'E', 'name': 'start', 'summary': ''}, ['start'])
     """
-    pass
+    __slots__ = ('node', 'strings', 'times', 'sizes', 'fields', 'contents', 'index')
+    #: .changes fields following the date
+    FIELDS = FIELDS
+    #: fields whose values are interned
+    INTERNED = ('mode', 'user', 'extra', 'flags')
+    #: whether each field is interned, in :py:attr:`FIELDS` order
+    CODED = tuple(map(INTERNED.__contains__, FIELDS))
+    #: revision count from which :py:meth:`find` keeps an index of times rather than scanning them
+    INDEXED = 64
+    #: indexes of the fields of revision rows in the database, following time and size
+    COLUMNS = tuple(map(FIELDS.index, ('mode', 'user', 'name', 'ip', 'summary', 'extra')))
+
+    def __init__(self, node, strings=None):
+        """
+        :param strings: :py:class:`DokuStrings` table of the site, a table of its own by default
+        """
+        self.node = node
+        self.strings = strings if strings is not None else DokuStrings()
+        self.times = array('q')
+        self.sizes = array('q')
+        self.fields = None
+        self.contents = None
+        #: index of each time, built by :py:meth:`find` once there are many
+        self.index = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, date):
+        return self.find(date) >= 0
+
+    def __getitem__(self, date):
+        i = self.find(date)
+        if i < 0:
+            raise KeyError(date)
+        return DokuRevision(self.node, i)
+
+    def find(self, date):
+        """Returns the index of revision `date`, -1 if there is none.
+
+        Times are scanned while there are few of them, and indexed from :py:attr:`INDEXED` on.
+        """
+        t = int(date)
+        if self.index is None:
+            if len(self.times) < self.INDEXED:
+                return self.times.index(t) if t in self.times else -1
+            self.index = {t: i for (i, t) in enumerate(self.times)}
+        return self.index.get(t, -1)
+
+    def add(self, date, size):
+        """Appends a revision without fields, returning its index."""
+        self.times.append(int(date))
+        self.sizes.append(size)
+        if self.index is not None:
+            self.index[self.times[-1]] = len(self.times) - 1
+        if self.fields is not None:
+            for coded, column in zip(self.CODED, self.fields):
+                column.append(0 if coded else None)
+        if self.contents is not None:
+            for column in self.contents:
+                column.append(None)
+        return len(self.times) - 1
+
+    def keys(self):
+        return [str(t) for t in self.times]
+
+    def values(self):
+        return [DokuRevision(self.node, i) for i in range(len(self.times))]
+
+    def items(self):
+        return [(str(t), DokuRevision(self.node, i)) for (i, t) in enumerate(self.times)]
+
+    def hasFields(self, i):
+        return self.fields is not None and any(column[i] if coded else column[i] is not None
+                                               for (coded, column) in zip(self.CODED, self.fields))
+
+    def getValue(self, k, i):
+        """Returns the value of the `k` th field of revision `i`."""
+        value = self.fields[k][i]
+        return self.strings[value] if self.CODED[k] else value
+
+    def getFields(self, i):
+        """Returns the .changes fields of revision `i` as a dict, None if it has none."""
+        if not self.hasFields(i):
+            return None
+        values = ((name, self.getValue(k, i)) for (k, name) in enumerate(self.FIELDS))
+        return {name: value for (name, value) in values if value is not None}
+
+    def getColumns(self, i, names):
+        """Returns the values of fields `names` for revision `i`."""
+        return [self.getValue(self.FIELDS.index(name), i) for name in names]
+
+    def persist2db(self, writer, node_id):
+        """Writes all revisions through `writer`, a column at a time rather than through
+        one :py:class:`DokuRevision` view per revision.
+
+        >>> import sqlite3
+        >>> from dokudb import DokuDbWriter
+        >>> conn = sqlite3.connect(":memory:")
+        >>> with open('dokudata.ddl') as f:
+        ...     conn.executescript(f.read()) and None
+        >>> revisions = DokuRevisions(None)
+        >>> for date in ('1367320600', '1367320658'):
+        ...     i = revisions.add(date, 42)
+        >>> revisions.setFields(1, {'mode': 'E', 'user': 'bob', 'summary': 'typo'})
+        >>> revisions.setContent(0, 120, 'c0ffee')
+        >>> writer = DokuDbWriter(conn)
+        >>> revisions.persist2db(writer, 1)
+        >>> writer.close()
+        >>> conn.execute("select time, size, mode, user, summary, raw_size, digest from revisions").fetchall()
+        [('1367320600', 42, None, None, None, 120, 'c0ffee'), ('1367320658', 42, 'E', 'bob', 'typo', None, None)]
+        """
+        n = len(self.times)
+        if self.fields is None:
+            columns = [[None] * n] * len(self.COLUMNS)
+        else:
+            strings = self.strings.strings
+            columns = [[strings[code] for code in self.fields[k]] if self.CODED[k] else self.fields[k]
+                       for k in self.COLUMNS]
+        contents = self.contents or ([None] * n, [None] * n)
+        add = writer.addRevision
+        for row in zip(self.times, self.sizes, *columns, *contents):
+            add(node_id, str(row[0]), *row[1:])
+
+    def setFields(self, i, fields):
+        self.allocFields()
+        code = self.strings.code
+        for name, coded, column in zip(self.FIELDS, self.CODED, self.fields):
+            value = fields.get(name)
+            column[i] = code(value) if coded else value
+
+    def allocFields(self):
+        if self.fields is None:
+            self.fields = [array('i', bytes(4 * len(self.times))) if coded else [None] * len(self.times)
+                           for coded in self.CODED]
+
+    def getContent(self, i):
+        """Returns the uncompressed size and digest of revision `i`, None when not verified."""
+        if self.contents is None:
+            return (None, None)
+        return (self.contents[0][i], self.contents[1][i])
+
+    def setContent(self, i, raw_size, digest):
+        if self.contents is None:
+            self.contents = ([None] * len(self.times), [None] * len(self.times))
+        self.contents[0][i] = raw_size
+        self.contents[1][i] = digest
+
+    def merge(self, log):
+        """Joins the entries of :py:class:`DokuChangelog` `log` to revisions, by a sort-merge on time.
+
+        Entries without a matching revision are added as missing ones, with a warning.
+
+        >>> log = DokuChangelog(None)
+        >>> log.parse("1367320658\\t1.2.3.4\\tE\\tstart\\tbob\\n1367320600\\t1.2.3.4\\tC\\tstart\\tann")
+        >>> revisions = DokuRevisions(None)
+        >>> for date in ('1367320658', '1367320600'):
+        ...     i = revisions.add(date, 42)
+        >>> revisions.merge(log)
+        >>> revisions.getFields(1)
+        {'ip': '1.2.3.4', 'mode': 'C', 'name': 'start', 'user': 'ann'}
+        """
+        if not len(log):
+            return
+        mine = self.times
+        order = sorted(range(len(mine)), key=mine.__getitem__)
+        theirs = log.times
+        logorder = range(len(theirs))
+        if any(theirs[k] > theirs[k + 1] for k in range(len(theirs) - 1)):
+            logorder = sorted(logorder, key=theirs.__getitem__)
+        matches = []
+        missing = []
+        j = 0
+        for k in logorder:
+            t = theirs[k]
+            while j < len(order) and mine[order[j]] < t:
+                j += 1
+            if j < len(order) and mine[order[j]] == t:
+                matches.append((order[j], k))
+            else:
+                missing.append(k)
+        for k in missing:
+            date = str(theirs[k])
+            i = self.find(date)
+            if i < 0:
+                logging.warning("Revision %s not found for %s", date, self.node.getFullname())
+                i = self.add(date, DokuFile.MISSING)
+            matches.append((i, k))
+        self.allocFields()
+        code = self.strings.code
+        for coded, column, values in zip(self.CODED, self.fields, log.fields):
+            if coded:
+                for i, k in matches:
+                    column[i] = code(values[k])
+            else:
+                for i, k in matches:
+                    column[i] = values[k]
+
 
 class DokuNode(DokuFile):
     """
     This is a base class for dokuwiki browsable objects, a page or media object.
     Element of a given `DokuNamespace`, it carries history, meta and indexing information.
+
+    Sizes of the associated meta files are kept as plain ints in :py:attr:`sz_changes`,
+    :py:attr:`sz_indexed` and :py:attr:`sz_meta`, None when there is no such file.
+
+    The .meta file is kept serialized, and only parsed on first access to :py:attr:`meta`,
+    with the :py:mod:`dokumeta` parser named by :py:attr:`metaBackend`.
     """
+    __slots__ = ('ns', 'name', 'revisions', 'sz_changes', 'sz_meta', 'sz_indexed', '_meta', '_metaRaw')
+    #: .meta parser, one of :py:data:`dokumeta.backends`
+    metaBackend = 'phpserialize'
+
     def __init__(self, ns, name, size):
         super().__init__(size)
         self.ns = ns
         self.name = name
-        self.revisions = {}
+        self.revisions = DokuRevisions(self, ns.strings)
         self.sz_changes = None
         self.sz_meta = None
         self.sz_indexed = None
-        self.meta = None
+        self._meta = None
+        self._metaRaw = None
 
     def isMissing(self):
         return self.size < 0
 
+    @property
+    def meta(self):
+        if self._metaRaw is not None:
+            self._meta = self.parseMeta(self._metaRaw)
+            self._metaRaw = None
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+        self._metaRaw = None
+
+    def getMetaBlob(self):
+        """Returns the serialized meta, as read from the .meta file when it was not modified."""
+        if self._metaRaw is not None:
+            return self._metaRaw
+        return serialize(self._meta)
+
     def addRevision(self, date, size):
         assert(date not in self.revisions)
-        rev = DokuRevision(self, date, size)
-        self.revisions[date] = rev
-        return rev
+        return DokuRevision(self, self.revisions.add(date, size))
 
     def getRevision(self, date):
-        if not date in self.revisions:
+        i = self.revisions.find(date)
+        if i < 0:
             logging.warning("Revision %s not found for %s", date, self.getFullname())
             rev = self.addRevision(date, DokuFile.MISSING)
         else:
-            rev = self.revisions[date]
+            rev = DokuRevision(self, i)
         return rev
 
+    @staticmethod
+    def parseMeta(data):
+        """Unserializes .meta file contents, given as bytes or str."""
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            return dokumeta.backends[DokuNode.metaBackend](data)
+        except Exception as e:
+            logging.error(e)
+            logging.info(data)
+            raise e
+
     def setChanges(self, text):
+        log = DokuChangelog(None)
+        log.parse(text)
+        self.loadChanges(log)
+
+    def loadChanges(self, log):
+        """Sets revision fields from a parsed :py:class:`DokuChangelog`."""
         assert self.sz_changes is None
-        self.sz_changes = DokuChanges(self, len(text))
-        for line in text.splitlines():
-            fields = line.split("\t")
-            date = fields[0]
-            z = zip(('ip', 'mode', 'name', 'user', 'summary', 'extra', 'flags'), fields[1:])
-            rev = self.getRevision(date)
-            rev.setMetaFields(dict(z))
+        self.sz_changes = log.size
+        self.revisions.merge(log)
 
     def setIndexed(self, text):
+        self.loadIndexed(len(text))
+
+    def loadIndexed(self, size):
         assert self.sz_indexed is None
-        self.sz_indexed = DokuIndexed(self, len(text))
+        self.sz_indexed = size
 
     def setMeta(self, text):
+        self.loadMeta(len(text), text.encode())
+
+    def loadMeta(self, size, data):
+        """Keeps serialized .meta contents `data` for parsing on demand."""
         assert self.sz_meta is None
-        self.sz_meta = DokuMeta(self, len(text))
-        try:
-            self.meta = unserialize(text.encode(), decode_strings=True)
-            logging.info(repr(self.meta))
-        except Exception as e:
-            logging.error(e)
-            logging.info(text)
-            self.meta = text
-            raise e
+        self.sz_meta = size
+        self._meta = None
+        self._metaRaw = data
 
     def summary(self):
-        print("  - [%s] %s - %d bytes - %d revisions : %s" % (
-            self.__class__.__name__, self.name, self.size, self.getRevCount(), 'MISSING' if self.isMissing() else ''))
+        print(self.getSummary())
+
+    def getSummary(self):
+        return "  - [%s] %s - %d bytes - %d revisions : %s" % (
+            self.__class__.__name__, self.name, self.size, self.getRevCount(), 'MISSING' if self.isMissing() else '')
 
     def getRevCount(self):
         return len(self.revisions)
 
-    def persist2db(self, c, ns_id):
-        sz_changes = self.sz_changes.size if self.sz_changes else self.MISSING
-        sz_indexed = self.sz_indexed.size if self.sz_indexed else self.MISSING
-        sz_meta = self.sz_meta.size if self.sz_meta else self.MISSING
-        c.execute('''
-        INSERT INTO nodes (type, ns_id, name, size,
-                           sz_changes, sz_indexed, sz_meta, meta)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (self.__class__.__name__, ns_id, self.name, self.size,
-            sz_changes, sz_indexed, sz_meta, serialize(self.meta)
-        ))
-        node_id = c.lastrowid
-        for date, rev in self.revisions.items():
-            rev.persist2db(c, node_id)
+    def persist2db(self, writer, ns_id):
+        sz_changes = self.sz_changes if self.sz_changes is not None else self.MISSING
+        sz_indexed = self.sz_indexed if self.sz_indexed is not None else self.MISSING
+        sz_meta = self.sz_meta if self.sz_meta is not None else self.MISSING
+        node_id = writer.addNode(self.__class__.__name__, ns_id, self.name, self.size,
+                                 sz_changes, sz_indexed, sz_meta, self.getMetaBlob())
+        self.revisions.persist2db(writer, node_id)
 
     def getFullname(self):
         return self.ns.getFullName() + self.ns.sep + self.name
 
 
 class DokuPage(DokuNode):
+    __slots__ = ()
+
     def __init__(self, ns, name, size):
         DokuNode.__init__(self, ns, name, size)
         logging.debug("Page: %s:%s", ns.name, name)
 
 
 class DokuMedia(DokuNode):
+    __slots__ = ()
+
     def __init__(self, ns, name, size):
         DokuNode.__init__(self, ns, name, size)
         logging.debug("Media: %s:%s", ns.name, name)
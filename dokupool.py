@@ -0,0 +1,49 @@
+"""Process pool shared by the data trees of a load, for the work they defer to other processes:
+parsing .changes files and verifying attic files.
+
+A single pool serves a whole load or walk, rather than one per namespace or per tree,
+whose start up would cost more than the work it does.
+"""
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+__author__ = 'mich'
+
+
+def open_pool(workers):
+    """Returns a pool of `workers` processes, to be used as a context manager,
+    or with 0 `workers`, a context providing None, for work done in the calling process.
+
+    >>> with open_pool(0) as executor:
+    ...     executor is None
+    True
+    """
+    if not workers:
+        return contextlib.nullcontext()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def map_chunks(executor, function, items, chunksize=64, key=lambda item: item.path):
+    """Runs `function` in `executor` over the paths of `items`, by chunks of `chunksize` paths,
+    and yields each item with its result.
+
+    `function` takes a list of paths and returns the list of their results: items stay
+    in the calling process, only paths and results go to and from the workers.
+    `key` may send something else than the path of each item, such as the path and size.
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> from dokuchanges import DokuChangelog
+    >>> logs = [DokuChangelog(path) for path in ('a.changes', 'bb.changes', 'ccc.changes')]
+    >>> with ThreadPoolExecutor(max_workers=2) as executor:
+    ...     [(log.path, size) for (log, size) in map_chunks(executor, lambda paths: list(map(len, paths)), logs, 2)]
+    [('a.changes', 9), ('bb.changes', 10), ('ccc.changes', 11)]
+    """
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+    batches = executor.map(function, [[key(item) for item in chunk] for chunk in chunks])
+    for chunk, batch in zip(chunks, batches):
+        yield from zip(chunk, batch)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
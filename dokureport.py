@@ -0,0 +1,125 @@
+import fnmatch
+import gzip
+import sys
+from contextlib import contextmanager
+
+__author__ = 'mich'
+
+
+class DokuReport:
+    """Org-mode report of a :py:class:`Doku` site, generated line by line.
+
+    The default report is the one :py:meth:`DokuNamespace.summary` prints.
+    Options make it shorter or richer, in the same single traversal of the namespace graph.
+
+    >>> from dokunamespace import DokuRoot
+    >>> class Site:
+    ...     path = ''
+    >>> root = DokuRoot(Site)
+    >>> for parts, name in (((), 'start'), (('wiki',), 'syntax'), (('wiki',), 'welcome'),
+    ...                     (('wiki', 'old'), 'draft'), (('private',), 'notes')):
+    ...     rev = root.getNamespacePath(parts).addPage(name, 120).addRevision('1367320658', 60)
+    >>> media = root.addMedia('logo.png', 300)
+    >>> report = DokuReport(max_depth=1, nodes=False, exclude=(':private:*',), aggregates=True)
+    >>> print("".join(report.lines(root)), end="")
+    * Namespace: :
+    :PROPERTIES:
+    :pages: 1
+    :medias: 1
+    :missing: 0
+    :revisions: 1
+    :END:
+    ** pages: 1
+    ** medias: 1
+    * Namespace: :wiki:
+    :PROPERTIES:
+    :pages: 2
+    :medias: 0
+    :missing: 0
+    :revisions: 2
+    :END:
+    ** pages: 2
+    >>> lines = list(DokuReport(max_nodes=4).lines(root))
+    >>> len(lines), lines[-1]
+    (12, '# Report truncated after 4 nodes\\n')
+    """
+
+    def __init__(self, max_depth=None, max_nodes=None, include=None, exclude=None, aggregates=False,
+                 nodes=True):
+        """
+        :param max_depth: depth of the deepest namespaces reported, the root being at depth 0
+        :param max_nodes: number of pages and medias after which the report stops
+        :param include: :py:mod:`fnmatch` patterns of the namespace full names reported, all by default;
+            others are skipped, but not their children
+        :param exclude: patterns of namespace full names skipped, with their children
+        :param aggregates: add a property drawer of page, media, missing node and revision counts
+            to each namespace
+        :param nodes: list pages and medias, not only their count
+        """
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.include = include
+        self.exclude = exclude
+        self.aggregates = aggregates
+        self.nodes = nodes
+
+    def matches(self, fullname, patterns):
+        return any(fnmatch.fnmatchcase(fullname, pattern) for pattern in patterns)
+
+    def lines(self, root):
+        """Yields the lines of the report on the namespaces below `root`, newlines included."""
+        count = 0
+        stack = [(root, 0)]
+        while stack:
+            ns, depth = stack.pop()
+            if self.exclude and self.matches(ns.fullname, self.exclude):
+                continue
+            if not self.include or self.matches(ns.fullname, self.include):
+                yield "* Namespace: %s\n" % ns.fullname
+                if self.aggregates:
+                    yield from self.properties(ns)
+                for title, nodes, always in (('pages', ns.pages, True), ('medias', ns.medias, False)):
+                    if not (always or nodes):
+                        continue
+                    yield "** %s: %d\n" % (title, len(nodes))
+                    if not self.nodes:
+                        continue
+                    for node in nodes.values():
+                        if self.max_nodes is not None and count >= self.max_nodes:
+                            yield "# Report truncated after %d nodes\n" % count
+                            return
+                        count += 1
+                        yield node.getSummary() + "\n"
+            if self.max_depth is None or depth < self.max_depth:
+                stack.extend((child, depth + 1) for child in reversed(list(ns.children.values())))
+
+    @staticmethod
+    def properties(ns):
+        nodes = list(ns.pages.values()) + list(ns.medias.values())
+        yield ":PROPERTIES:\n"
+        yield ":pages: %d\n" % len(ns.pages)
+        yield ":medias: %d\n" % len(ns.medias)
+        yield ":missing: %d\n" % sum(1 for node in nodes if node.isMissing())
+        yield ":revisions: %d\n" % sum(node.getRevCount() for node in nodes)
+        yield ":END:\n"
+
+    def write(self, root, out):
+        """Writes the report into text file `out`, by buffered chunks of lines."""
+        out.writelines(self.lines(root))
+
+
+@contextmanager
+def open_sink(path, buffer_size=1024 * 1024):
+    """Opens a buffered text sink for a report: standard output for ``-``,
+    a gzip file for a name ending with ``.gz``, a plain file otherwise."""
+    if path == '-':
+        try:
+            yield sys.stdout
+        finally:
+            sys.stdout.flush()
+    elif path.endswith('.gz'):
+        with gzip.open(path, 'wt') as out:
+            yield out
+    else:
+        with open(path, 'w', buffering=buffer_size) as out:
+            yield out
@@ -0,0 +1,116 @@
+import gc
+import logging
+import os
+import pickle
+from dokutree import check_private
+
+__author__ = 'mich'
+
+
+class DokuSnapshot:
+    """Binary snapshot of the namespace, node and revision graph of a loaded :py:class:`Doku` site.
+
+    Revisions are already stored as arrays, and .meta files as unparsed bytes, so the
+    snapshot is a compact pickle of the graph, with the :py:class:`DokuStrings` table of the site.
+    Keep it in a :py:func:`private_dir`: it is not restored if it belongs to another user.
+
+    The snapshot is keyed by the site version and by the mtimes of the data trees
+    and of their top-level entries, files and namespaces.
+    Any page edit appends to ``meta/_dokuwiki.changes``, and any media upload to
+    ``media_meta/_media.changes``, which invalidates the snapshot. Changes made deeper
+    by other means, for instance by hand, are only seen when they reach one of these
+    directories: remove the snapshot file to force a full load.
+
+    >>> import tempfile
+    >>> from doku import Doku
+    >>> files = {'VERSION': '2013-05-10', 'data/pages/start.txt': 'hello', 'data/pages/wiki/syntax.txt': 'hello',
+    ...          'data/attic/start.1367320600.txt.gz': '', 'data/media/logo.png': '',
+    ...          'data/media_attic/logo.1367320600.png': '',
+    ...          'data/meta/start.changes': "1367320600\\t10.0.0.1\\tC\\tstart\\tbob\\t\\t\\n"}
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     for relpath, text in files.items():
+    ...         os.makedirs(os.path.dirname(os.path.join(path, relpath)), exist_ok=True)
+    ...         with open(os.path.join(path, relpath), 'w') as f:
+    ...             n = f.write(text)
+    ...     Doku(path).load(snapshot=os.path.join(path, 'snapshot'))
+    ...     wiki = Doku(path)
+    ...     wiki.load(snapshot=os.path.join(path, 'snapshot'))
+    >>> sorted(wiki.metrics.phases), sorted(wiki.root.children), wiki.root.getDoku() is wiki
+    (['snapshot.restore'], ['wiki'], True)
+    >>> wiki.root.pages['start'].revisions.getFields(0)['user']
+    'bob'
+    """
+    #: Snapshot format version
+    version = 2
+
+    def __init__(self, path, wiki, verify=False):
+        """
+        :param verify: whether the site is loaded with verified attic files,
+            a snapshot without them cannot stand for such a load
+        """
+        self.path = path
+        self.wiki = wiki
+        self.verify = verify
+        #: key of the data trees before they are loaded
+        self.current = None
+
+    def key(self):
+        """Returns the site version and mtimes the snapshot was made for."""
+        key = [self.wiki.version, self.verify]
+        with os.scandir(self.wiki.root.getDataPath()) as trees:
+            for tree in sorted(trees, key=lambda e: e.name):
+                key.append((tree.name, tree.stat().st_mtime_ns))
+                if tree.is_dir():
+                    with os.scandir(tree.path) as it:
+                        key.extend(sorted((tree.name, e.name, e.stat().st_mtime_ns) for e in it))
+        return key
+
+    def restore(self):
+        """Replaces the namespace graph of the site by the snapshot one.
+
+        Returns False, leaving the site untouched, when there is no valid snapshot.
+        """
+        self.current = self.key()
+        if not os.path.exists(self.path):
+            return False
+        with self.wiki.metrics.phase('snapshot.restore'):
+            try:
+                with open(self.path, 'rb') as f:
+                    check_private(f)
+                    (version, key) = pickle.load(f)
+                    if version != self.version or key != self.current:
+                        logging.info("Snapshot %s is out of date", self.path)
+                        return False
+                    (root, counters) = self.unpickle(f)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+                logging.warning("Ignoring snapshot %s: %s", self.path, e)
+                return False
+            root.doku = self.wiki
+            self.wiki.root = root
+            for treename, tree in counters.items():
+                self.wiki.metrics.addTree(treename, tree)
+        logging.info("Restored snapshot %s", self.path)
+        return True
+
+    @staticmethod
+    def unpickle(f):
+        """Unpickles the graph with the garbage collector paused: it holds no garbage,
+        but a lot of new objects, which would trigger useless collections."""
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.load(f)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def save(self):
+        """Writes the snapshot of the site, as currently loaded,
+        keyed by the state of data trees when :py:meth:`restore` failed."""
+        with self.wiki.metrics.phase('snapshot.save'):
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump((self.version, self.current or self.key()), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((self.wiki.root, self.wiki.metrics.trees), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
@@ -0,0 +1,217 @@
+"""Revision statistics of a loaded site, computed over NumPy arrays.
+
+:py:class:`DokuStats` turns revisions into flat arrays of times, sizes, node, namespace,
+user and mode codes. The functions below group, bucket and count such arrays without
+a Python loop per revision, which answers questions like edits per user and month,
+attic growth, or revision sizes per namespace, over millions of revisions in memory.
+
+:py:mod:`numpy` is only needed by this module.
+"""
+from array import array
+from dokunode import DokuRevisions
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'mich'
+
+#: NumPy datetime64 units of time buckets, by name
+UNITS = {'year': 'Y', 'month': 'M', 'week': 'W', 'day': 'D', 'hour': 'h'}
+
+
+def time_buckets(times, unit='month'):
+    """Returns the `unit` bucket of each time, in seconds since the epoch, as datetime64 values."""
+    return numpy.asarray(times).astype('datetime64[s]').astype('datetime64[%s]' % UNITS[unit])
+
+
+def group_by(keys, values=None, how='count'):
+    """Groups `values` by `keys`, one array or a tuple of arrays, and reduces each group.
+
+    Returns the sorted distinct keys, an array or a tuple of arrays like `keys`, and the array
+    of group results: their ``count``, or the ``sum``, ``mean``, ``min`` or ``max`` of their values.
+    """
+    columns = keys if isinstance(keys, tuple) else (keys,)
+    # each key column is numbered, and numbers are combined into a single integer key,
+    # which sorts like key tuples and much faster than records would
+    labels = []
+    combined = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    for column in columns:
+        (unique, inverse) = numpy.unique(column, return_inverse=True)
+        labels.append(unique)
+        combined = combined * len(unique) + inverse.ravel()
+    if numpy.prod([float(len(unique)) for unique in labels]) >= 2 ** 63:
+        raise ValueError("Too many distinct keys to group by")
+    (unique, inverse) = numpy.unique(combined, return_inverse=True)
+    inverse = inverse.ravel()
+    size = len(unique)
+    groups = []
+    for column in reversed(labels):
+        (unique, number) = numpy.divmod(unique, len(column))
+        groups.insert(0, column[number])
+    if how == 'count':
+        result = numpy.bincount(inverse, minlength=size)
+    elif how in ('sum', 'mean'):
+        result = numpy.bincount(inverse, weights=values, minlength=size)
+        if how == 'mean':
+            result = result / numpy.bincount(inverse, minlength=size)
+    elif how in ('min', 'max'):
+        reduce = numpy.minimum if how == 'min' else numpy.maximum
+        result = numpy.full(size, values.max() if how == 'min' else values.min(), dtype=values.dtype)
+        reduce.at(result, inverse, values)
+    else:
+        raise ValueError("Unknown reduction %s" % how)
+    return (tuple(groups) if isinstance(keys, tuple) else groups[0]), result
+
+
+def histogram(values, bins=None):
+    """Returns the counts of `values` and the bin edges, power-of-two bins by default, as
+    :py:meth:`DokuIndex.getSizeBuckets`: the first bin counts zeros, bin `b` values from
+    ``2 ** (b - 1)`` to ``2 ** b - 1``."""
+    values = numpy.asarray(values)
+    if bins is None:
+        top = int(values.max()).bit_length() if len(values) else 0
+        bins = numpy.concatenate(([0], 2 ** numpy.arange(top + 1)))
+    return numpy.histogram(values, bins)
+
+
+class DokuStats:
+    """Revisions of a loaded :py:class:`Doku` site, as NumPy arrays.
+
+    :py:attr:`times`, :py:attr:`sizes`, :py:attr:`nodes`, :py:attr:`ns`, :py:attr:`users` and
+    :py:attr:`modes` have one entry per revision. Nodes and namespaces are numbered in the order
+    of :py:attr:`nodeNames` and :py:attr:`namespaces`; users and modes are codes of the
+    :py:class:`DokuStrings` table of the site, 0 meaning no value. Sizes of missing attic files are
+    :py:attr:`DokuFile.MISSING`.
+    """
+    USER = DokuRevisions.FIELDS.index('user')
+    MODE = DokuRevisions.FIELDS.index('mode')
+
+    def __init__(self, wiki):
+        """
+        :param wiki: the loaded :py:class:`Doku` site
+        """
+        if numpy is None:
+            raise ImportError("Revision statistics need numpy")
+        self.wiki = wiki
+        #: namespace full names, and full names of nodes with their namespace number
+        self.namespaces = []
+        self.nodeNames = []
+        nodeNs = array('i')
+        counts = array('q')
+        (times, sizes, users, modes) = (array('q'), array('q'), array('i'), array('i'))
+        stack = [wiki.root]
+        while stack:
+            ns = stack.pop()
+            number = len(self.namespaces)
+            self.namespaces.append(ns.fullname)
+            for node in list(ns.pages.values()) + list(ns.medias.values()):
+                revisions = node.revisions
+                self.nodeNames.append(node.getFullname())
+                nodeNs.append(number)
+                counts.append(len(revisions))
+                times.extend(revisions.times)
+                sizes.extend(revisions.sizes)
+                if revisions.fields is not None:
+                    users.extend(revisions.fields[self.USER])
+                    modes.extend(revisions.fields[self.MODE])
+                else:
+                    users.extend(array('i', bytes(4 * len(revisions))))
+                    modes.extend(array('i', bytes(4 * len(revisions))))
+            stack.extend(ns.children.values())
+        self.times = numpy.frombuffer(times, dtype=numpy.int64)
+        self.sizes = numpy.frombuffer(sizes, dtype=numpy.int64)
+        self.users = numpy.frombuffer(users, dtype=numpy.int32)
+        self.modes = numpy.frombuffer(modes, dtype=numpy.int32)
+        self.nodeNs = numpy.frombuffer(nodeNs, dtype=numpy.int32)
+        self.nodes = numpy.repeat(numpy.arange(len(self.nodeNames), dtype=numpy.int32),
+                                  numpy.frombuffer(counts, dtype=numpy.int64))
+        self.ns = self.nodeNs[self.nodes]
+
+    def __len__(self):
+        return len(self.times)
+
+    def strings(self, codes):
+        """Returns the strings of :py:class:`DokuStrings` `codes`."""
+        strings = self.wiki.root.strings
+        return [strings[int(code)] for code in codes]
+
+    def getUserActivity(self, unit='month'):
+        """Returns revision counts by user and time bucket, as ``(user, bucket, count)`` tuples."""
+        ((users, buckets), counts) = group_by((self.users, time_buckets(self.times, unit)))
+        return list(zip(self.strings(users), buckets.astype(str).tolist(), counts.tolist()))
+
+    def getNamespaceActivity(self, unit='month'):
+        """Returns revision counts by namespace full name, then by time bucket."""
+        ((ns, buckets), counts) = group_by((self.ns, time_buckets(self.times, unit)))
+        activity = {}
+        for number, bucket, count in zip(ns.tolist(), buckets.astype(str).tolist(), counts.tolist()):
+            activity.setdefault(self.namespaces[number], {})[bucket] = count
+        return activity
+
+    def getAtticGrowth(self, unit='month'):
+        """Returns time buckets, with the bytes of attic files they added and their running total."""
+        present = self.sizes >= 0
+        (buckets, added) = group_by(time_buckets(self.times[present], unit), self.sizes[present], 'sum')
+        added = added.astype(numpy.int64)
+        return list(zip(buckets.astype(str).tolist(), added.tolist(), numpy.cumsum(added).tolist()))
+
+    def getSizeHistograms(self, bins=None):
+        """Returns the :py:func:`histogram` of attic file sizes of each namespace, by full name,
+        with the common bin edges. As with :py:func:`numpy.histogram`, sizes outside of
+        the edges are not counted, and the last bin includes its right edge."""
+        present = self.sizes >= 0
+        (counts, edges) = histogram(self.sizes[present], bins)
+        inside = present & (self.sizes >= edges[0]) & (self.sizes <= edges[-1])
+        bin = numpy.searchsorted(edges, self.sizes[inside], side='right') - 1
+        bin = numpy.minimum(bin, len(counts) - 1)
+        ((ns, bins), counts) = group_by((self.ns[inside], bin))
+        histograms = {}
+        for number, b, count in zip(ns.tolist(), bins.tolist(), counts.tolist()):
+            histograms.setdefault(self.namespaces[number], [0] * (len(edges) - 1))[b] = count
+        return histograms, edges.tolist()
+
+
+_examples = """
+>>> from dokunamespace import DokuRoot
+>>> class Site:
+...     path = ''
+>>> root = Site.root = DokuRoot(Site)
+>>> page = root.addPage('start', 120)
+>>> for date, size in (('1300000000', 100), ('1300086400', 300), ('1331000000', 700)):
+...     rev = page.addRevision(date, size)
+>>> page.setChanges("1300000000\\t1.2.3.4\\tC\\tstart\\tann\\n1300086400\\t1.2.3.4\\tE\\tstart\\tbob\\n"
+...                 "1331000000\\t1.2.3.4\\tE\\tstart\\tann\\n")
+>>> rev = root.getNamespace('wiki').addMedia('logo.png', 300).addRevision('1300000000', -1)
+>>> stats = DokuStats(Site)
+>>> len(stats), stats.namespaces, stats.nodeNames
+(4, [':', ':wiki:'], ['::start', ':wiki::logo.png'])
+>>> stats.getUserActivity('year')
+[(None, '2011', 1), ('ann', '2011', 1), ('ann', '2012', 1), ('bob', '2011', 1)]
+>>> stats.getNamespaceActivity('year')
+{':': {'2011': 2, '2012': 1}, ':wiki:': {'2011': 1}}
+>>> stats.getAtticGrowth('year')
+[('2011', 400, 400), ('2012', 700, 1100)]
+>>> stats.getSizeHistograms()
+({':': [0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1]}, [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024])
+>>> stats.getSizeHistograms([200, 400, 600]), histogram(stats.sizes[stats.sizes >= 0], [200, 400, 600])[0].tolist()
+(({':': [1, 0]}, [200, 400, 600]), [1, 0])
+>>> stats.getSizeHistograms([0, 50])
+({}, [0, 50])
+>>> keys, sums = group_by((numpy.array([2, 1, 2]), numpy.array([5, 5, 5])), numpy.array([1, 2, 3]), 'sum')
+>>> keys[0].tolist(), keys[1].tolist(), sums.tolist()
+([1, 2], [5, 5], [2.0, 4.0])
+>>> group_by(numpy.array([2, 1, 2]), numpy.array([1, 2, 3]), 'max')[1].tolist()
+[2, 3]
+>>> time_buckets([1300000000], 'day').astype(str).tolist()
+['2011-03-13']
+"""
+
+# examples need numpy
+__test__ = {'DokuStats': _examples} if numpy is not None else {}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)
@@ -1,10 +1,226 @@
+import collections
+import functools
 import logging
 import os
+import pickle
 import re
+import stat
+from dokuattic import DokuAtticContent, verify
+from dokuchanges import DokuChangelog, ingest
+from dokunode import DokuFile
 
 __author__ = 'mich'
 
 
+def scantree(top, ignore=None, iterative=False, scandir=None):
+    """Walks a directory tree with :py:func:`os.scandir`, one directory at a time.
+
+    Yields a ``(parts, files)`` tuple for each directory, `parts` being the tuple of
+    subdirectory names leading from `top` to it, and `files` a list of
+    ``(entry, abspath, stat)`` for its regular entries. Directory types come from the
+    cached :py:class:`os.DirEntry` data, so each file costs a single ``stat`` call,
+    which provides both size and mtime.
+
+    With `iterative`, an explicit stack replaces recursion, so that deep namespaces
+    cannot hit the interpreter recursion limit.
+
+    `scandir` may replace the listing of a single directory: called with
+    ``(parts, dirpath)``, it returns the `files` list and the list of
+    ``(entry, abspath)`` subdirectories.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as top:
+    ...     os.mkdir(os.path.join(top, 'ns'))
+    ...     open(os.path.join(top, 'ns', 'start.txt'), 'w').write('hello')
+    ...     [(parts, [(e, st.st_size) for (e, p, st) in files])
+    ...      for (parts, files) in scantree(top, iterative=True)]
+    5
+    [((), []), (('ns',), [('start.txt', 5)])]
+    """
+    if scandir is None:
+        scandir = lambda parts, dirpath: _scandir(dirpath, ignore)
+    if iterative:
+        stack = [((), top)]
+        while stack:
+            parts, dirpath = stack.pop()
+            files, subdirs = scandir(parts, dirpath)
+            yield parts, files
+            for entry, abspath in reversed(subdirs):
+                stack.append((parts + (entry,), abspath))
+    else:
+        yield from _scantree(top, (), scandir)
+
+
+def _scantree(dirpath, parts, scandir):
+    files, subdirs = scandir(parts, dirpath)
+    yield parts, files
+    for entry, abspath in subdirs:
+        yield from _scantree(abspath, parts + (entry,), scandir)
+
+
+def _scandir(dirpath, ignore):
+    files = []
+    subdirs = []
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    with os.scandir(dirpath) as it:
+        for e in it:
+            if ignore and ignore(e.name):
+                continue
+            if debug:
+                logging.debug("* direntry: %s", e.path)
+            if e.is_dir():
+                subdirs.append((e.name, e.path))
+            else:
+                files.append((e.name, e.path, e.stat()))
+    return files, subdirs
+
+
+def _collect(scanned):
+    return list(scanned)
+
+
+def private_dir(path):
+    """Creates directory `path`, only accessible to the current user, and returns it.
+
+    Scan manifests and snapshots are pickles, and unpickling a file runs any code it holds:
+    they must not be left where other users could write them, such as directly in /tmp.
+    An existing `path` is only accepted if it is a private directory of the current user.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as top:
+    ...     path = private_dir(os.path.join(top, 'state'))
+    ...     oct(os.stat(path).st_mode & 0o777), private_dir(path) == path
+    ('0o700', True)
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError("%s is not a private directory" % path)
+    return path
+
+
+def check_private(f):
+    """Raises PermissionError unless open file `f` belongs to the current user,
+    and other users cannot write it, before it is unpickled, see :py:func:`private_dir`."""
+    st = os.fstat(f.fileno())
+    if st.st_uid != os.getuid() or st.st_mode & 0o002:
+        raise PermissionError("%s may have been written by another user" % f.name)
+
+
+#: Size and mtime of a file, as recorded by a :py:class:`DokuScanManifest`, in place of its stat result
+FileStat = collections.namedtuple('FileStat', ('st_size', 'st_mtime_ns'))
+
+
+class DokuScanManifest:
+    """What data trees contained at the previous load, for incremental rescans.
+
+    For each directory, the manifest records its mtime, the names of its subdirectories
+    and the size and mtime of each file, nothing more, so that it stays small.
+    A directory whose mtime did not change is not listed again: its files are only
+    checked with a ``stat``, or not at all for trees whose files are never modified in place,
+    which stand for the bulk of a site. Files are still read as by a plain scan,
+    the manifest only counts those whose size or mtime changed, and is not saved again
+    when there are none.
+
+    The manifest is a pickle: keep it in a :py:func:`private_dir`. It is not loaded
+    if it belongs to another user.
+
+    >>> import tempfile
+    >>> from dokunamespace import DokuRoot
+    >>> class Site:
+    ...     path = None
+    >>> with tempfile.TemporaryDirectory() as top:
+    ...     Site.path = top
+    ...     os.makedirs(os.path.join(top, 'data', 'attic', 'ns'))
+    ...     open(os.path.join(top, 'data', 'attic', 'ns', 'start.1367320658.txt.gz'), 'wb').close()
+    ...     path = os.path.join(private_dir(os.path.join(top, 'state')), 'manifest')
+    ...     for run in range(2):
+    ...         manifest = DokuScanManifest(path, os.path.join(top, 'data'))
+    ...         root = DokuRoot(Site)
+    ...         DokuAttic(root, manifest=manifest).loadRoot()
+    ...         manifest.save()
+    ...         (manifest.rewalked, manifest.reused, manifest.changed, os.path.getsize(path) < 200)
+    ...         len(root.children['ns'].pages['start'].revisions)
+    (2, 0, 1, True)
+    1
+    (0, 2, 0, True)
+    1
+    """
+    #: Manifest format version
+    version = 3
+
+    def __init__(self, path, datapath):
+        self.path = path
+        self.datapath = datapath
+        self.previous = {}
+        self.trees = {}
+        #: directories listed again, directories reused, files changed or added, directories dropped
+        self.rewalked = 0
+        self.reused = 0
+        self.changed = 0
+        self.dropped = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    check_private(f)
+                    (version, datapath, trees) = pickle.load(f)
+            except PermissionError as e:
+                logging.warning("Ignoring scan manifest: %s", e)
+                return
+            if version == self.version and datapath == self.datapath:
+                self.previous = trees
+            else:
+                logging.warning("Ignoring scan manifest %s, made for %s", path, datapath)
+
+    def scandir(self, tree, parts, dirpath):
+        """Lists one directory of `tree` on behalf of :py:meth:`DokuTree.scandir`,
+        returning the ``(entry, abspath, stat)`` of its files and the ``(entry, abspath)``
+        of its subdirectories."""
+        dirmtime = os.stat(dirpath).st_mtime_ns
+        # the previous state of the directory is dropped once replaced, not kept twice
+        (oldmtime, oldfiles, subdirs) = self.previous.get(tree.treename, {}).pop(parts, (None, {}, None))
+        if dirmtime == oldmtime:
+            self.reused += 1
+            subdirs = [(entry, os.path.join(dirpath, entry)) for entry in subdirs]
+            files = [(entry, os.path.join(dirpath, entry)) for entry in oldfiles]
+            if tree.immutable:
+                files = [(entry, abspath, FileStat(*oldfiles[entry])) for (entry, abspath) in files]
+            else:
+                files = [(entry, abspath, os.stat(abspath)) for (entry, abspath) in files]
+        else:
+            self.rewalked += 1
+            files, subdirs = _scandir(dirpath, tree.ignore)
+        stats = {entry: (st.st_size, st.st_mtime_ns) for (entry, abspath, st) in files}
+        self.changed += sum(oldfiles.get(entry) != stat for (entry, stat) in stats.items())
+        self.trees.setdefault(tree.treename, {})[parts] = (dirmtime, stats, [entry for (entry, abspath) in subdirs])
+        return files, subdirs
+
+    def update(self):
+        """Folds the directories scanned so far into the previous state, so that a long-running
+        process may rescan some directories again and again, and save the whole state."""
+        for treename, dirs in self.trees.items():
+            self.previous.setdefault(treename, {}).update(dirs)
+        self.trees = self.previous
+
+    def forget(self, parts):
+        """Drops the directories of namespace `parts` and of its descendants, once removed."""
+        for dirs in self.previous.values():
+            for key in [key for key in dirs if key[:len(parts)] == parts]:
+                del dirs[key]
+                self.dropped += 1
+
+    def save(self):
+        """Writes the manifest, unless no directory and no file changed since it was loaded."""
+        logging.info("Scan manifest: %d directories rewalked, %d reused, %d files changed",
+                     self.rewalked, self.reused, self.changed)
+        if not (self.rewalked or self.changed or self.dropped):
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((self.version, self.datapath, self.trees), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+
 class DokuTree:
     """Abstract Base Class. Manages one of the dokuwiki data subdirectories : pages, meta, media, attic etc ...
 
@@ -13,48 +229,143 @@ class DokuTree:
     """
     #: filename pattern
     pattern = re.compile('^(.*)(\.[^.]*)$')
+    #: whether files are never modified in place, once created
+    immutable = False
 
 
-    def __init__(self, root, treename):
+    def __init__(self, root, treename, manifest=None, executor=None, verify=False):
+        """
+        :param manifest: :py:class:`DokuScanManifest` for incremental scans
+        :param executor: process pool parsing file contents, for trees which parse any,
+            see :py:func:`open_pool`
+        :param verify: check file contents, for trees which can
+        """
         self.root = root
         self.treename = treename
-        logging.info("* Loading " + treename)
+        self.manifest = manifest
+        self.executor = executor
+        self.verify = verify
+        #: scanned directories and files, their bytes and the entries which could not be loaded
+        self.counters = {'dirs': 0, 'files': 0, 'bytes': 0, 'errors': 0}
+        logging.info("* Loading %s", treename)
 
     def getPattern(self):
         return self.pattern
 
     def parse(self, filename):
+        """Splits `filename` into the groups of :py:attr:`pattern`.
+
+        :py:meth:`fastParse` handles common names, the regex the others, and reports errors.
+        """
+        names = self.fastParse(filename)
+        if names is None:
+            names = self.parsePattern(filename)
+        return names
+
+    def parseBatch(self, filenames):
+        """Parses a whole directory listing, see :py:meth:`parse`."""
+        fast = self.fastParse
+        return [fast(filename) or self.parsePattern(filename) for filename in filenames]
+
+    def fastParse(self, filename):
+        """Splits `filename` like :py:attr:`pattern` does, with string methods rather than the regex.
+
+        Returns None when it cannot tell, `filename` being left to the regex.
+        """
+        i = filename.rfind('.')
+        if i < 0 or '\n' in filename:
+            return None
+        return (filename[:i], filename[i:])
+
+    def parsePattern(self, filename):
         m = self.getPattern().match(filename)
         if not m:
             raise ValueError("Parsing %s as %s entry with /%s/", filename, self.treename, self.getPattern().pattern )
         return tuple(m.groups())
 
-    def add_node(self, entry, abspath, ns):
+    def read(self, entry, abspath, st, names):
+        """Returns the file contents :py:meth:`add_node` needs, if any,
+        `names` being the result of :py:meth:`parse`.
+
+        It is called while scanning, possibly from a worker thread,
+        so it must not touch the namespace graph.
+        """
+        return None
+
+    def add_node(self, entry, abspath, ns, st, data, names=None):
+        """Adds a scanned entry to namespace `ns`, `names` being the result of :py:meth:`parse`
+        when already known."""
         raise NotImplementedError("Pure Virtual")
 
-    def loadRoot(self):
-        return self.load(self.root, self.root.getPathFor(self.treename))
+    def finish(self):
+        """Completes work deferred by :py:meth:`add_node`, once scanned entries are applied."""
+        pass
+
+    def loadRoot(self, iterative=False):
+        return self.load(self.root, self.root.getPathFor(self.treename), iterative)
 
-    def load(self, ns, dirpath):
+    def load(self, ns, dirpath, iterative=False):
         """Scans a directory tree and builds site structure"""
         assert(dirpath)
         logging.info("* Loading tree: %s", dirpath)
-        #dirpath = ns.getPath(self.treename)
-        for entry in os.listdir(dirpath):
-            if self.ignore(entry):
-                continue
-            abspath = os.path.join(dirpath, entry)
-            logging.debug("* direntry: %s", abspath)
-            if os.path.isdir(abspath):
-                self.load(ns.getNamespace(entry), abspath)
-            else:
-                self.add_node(entry, abspath, ns)
+        self.apply(ns, self.scan(dirpath, iterative))
+        self.finish()
+
+    def scan(self, dirpath, iterative=False, parts=()):
+        """Walks a directory tree without touching the namespace graph.
+
+        Yields ``(parts, files)`` for each directory, `files` being a list of
+        ``(entry, abspath, stat, data, names)``, `data` coming from :py:meth:`read`,
+        and `names` from :py:meth:`parseBatch`, which parses each listing once.
+        """
+        scandir = lambda subparts, subpath: self.scandir(parts + subparts, subpath)
+        for subparts, files in scantree(dirpath, iterative=iterative, scandir=scandir):
+            yield parts + subparts, files
+
+    def scandir(self, parts, dirpath):
+        """Lists one directory, through the scan manifest if any, and reads its files."""
+        if self.manifest is not None:
+            files, subdirs = self.manifest.scandir(self, parts, dirpath)
+        else:
+            files, subdirs = _scandir(dirpath, self.ignore)
+        parsed = self.parseBatch([f[0] for f in files])
+        return [(entry, abspath, st, self.read(entry, abspath, st, names), names)
+                for ((entry, abspath, st), names) in zip(files, parsed)], subdirs
+
+    def scanTasks(self, iterative=False, split=False):
+        """Prepares the scan of the whole tree for concurrent execution.
+
+        Returns a list of callables, each returning the list of scanned directories
+        of one part of the tree. With `split`, there is one part for the top-level
+        files and one per top-level namespace, otherwise a single one.
+        Results must be applied in list order to keep the sequential semantics.
+        """
+        dirpath = self.root.getPathFor(self.treename)
+        logging.info("* Loading tree: %s", dirpath)
+        if not split:
+            return [lambda: list(self.scan(dirpath, iterative))]
+        files, subdirs = self.scandir((), dirpath)
+        tasks = [lambda: [((), files)]]
+        for entry, abspath in subdirs:
+            tasks.append(functools.partial(_collect, self.scan(abspath, iterative, (entry,))))
+        return tasks
+
+    def apply(self, ns, scanned):
+        """Adds scanned directories, as yielded by :py:meth:`scan`, below namespace `ns`."""
+        counters = self.counters
+        for parts, files in scanned:
+            subns = ns.getNamespacePath(parts)
+            counters['dirs'] += 1
+            counters['files'] += len(files)
+            for entry, abspath, st, data, names in files:
+                counters['bytes'] += st.st_size
+                self.add_node(entry, abspath, subns, st, data, names)
 
     def ignore(self, entry):
         return (entry=='_dummy')
 
-    def getsize(self, abspath):
-        return os.path.getsize(abspath)
+    def getsize(self, st):
+        return st.st_size
 
 
 class DokuPagesTree(DokuTree):
@@ -65,8 +376,8 @@ class DokuPagesTree(DokuTree):
 
     """
     pattern = re.compile('^(.*)(\.txt)$')
-    def __init__(self, doku):
-        super().__init__(doku, "pages")
+    def __init__(self, doku, manifest=None, executor=None, verify=False):
+        super().__init__(doku, "pages", manifest, executor, verify)
 
     def _parse0(self, entry):
         if not (entry.endswith('.txt')):
@@ -79,12 +390,17 @@ class DokuPagesTree(DokuTree):
 
 
 
-    def add_node(self, entry, abspath, ns):
-        (name, ext) = self.parse(entry)
+    def fastParse(self, filename):
+        if not filename.endswith('.txt') or '\n' in filename:
+            return None
+        return (filename[:-4], '.txt')
+
+    def add_node(self, entry, abspath, ns, st, data, names=None):
+        (name, ext) = names or self.parse(entry)
         if ext != '.txt':
             logging.error("Page extension should be .txt", entry)
             name = entry
-        ns.addPage(name, self.getsize(abspath))
+        ns.addPage(name, self.getsize(st))
 
 
 class DokuMediaTree(DokuTree):
@@ -94,18 +410,18 @@ class DokuMediaTree(DokuTree):
     ('calendrier', '.jpg')
 
     """
-    def __init__(self, doku):
-        super().__init__(doku, "media")
+    def __init__(self, doku, manifest=None, executor=None, verify=False):
+        super().__init__(doku, "media", manifest, executor, verify)
 
     # def parse(self, filename):
     #     return (filename)
 
-    def add_node(self, entry, abspath, ns):
+    def add_node(self, entry, abspath, ns, st, data, names=None):
         # here, we parse just for checking
-        (name, ext) = self.parse(entry)
-        # ns.addMedia(name+ext, self.getsize(abspath))
+        (name, ext) = names or self.parse(entry)
+        # ns.addMedia(name+ext, self.getsize(st))
         # we'd better keep full name here
-        ns.addMedia(entry, self.getsize(abspath))
+        ns.addMedia(entry, self.getsize(st))
 
 class DokuAttic(DokuTree):
     """
@@ -116,16 +432,73 @@ class DokuAttic(DokuTree):
     >>> tree = DokuAttic(None)
     >>> tree.parse("calendrier.1367320658.txt.gz")
     ('calendrier', '1367320658', '.txt.gz')
+    >>> tree.parseBatch(["notes.v2.1367320658.txt.gz", "archive.1367320658.tar.txt.gz"])
+    [('notes.v2', '1367320658', '.txt.gz'), ('archive', '1367320658', '.tar.txt.gz')]
 """
     pattern = re.compile('^(.*)\.([0-9]+)(\..*)$')
 
-    def __init__(self, doku, treename="attic"):
-        super().__init__(doku, treename)
-
-    def add_node(self, entry, abspath, ns):
-        (name, rev, ext) = self.parse(entry)
+    immutable = True
+
+    def __init__(self, doku, treename="attic", manifest=None, executor=None, verify=False):
+        """
+        With `verify`, revision files are decompressed and hashed, see :py:class:`DokuAtticContent`,
+        by the process pool `executor` in :py:meth:`finish` if any, otherwise while scanning.
+        """
+        super().__init__(doku, treename, manifest, executor, verify)
+        self.pending = []
+
+    def read(self, entry, abspath, st, names):
+        if not self.verify:
+            return None
+        content = DokuAtticContent(abspath)
+        if self.executor is None:
+            content.check()
+        return content
+
+    def fastParse(self, filename):
+        if '\n' in filename:
+            return None
+        # the rightmost all-digits part followed by a one or two parts extension,
+        # as the greedy regex finds; longer extensions are left to the regex
+        parts = filename.rsplit('.', 3)
+        if len(parts) >= 3:
+            rev = parts[-2]
+            if rev.isdigit() and rev.isascii():
+                return ('.'.join(parts[:-2]), rev, '.' + parts[-1])
+            if len(parts) == 4:
+                rev = parts[1]
+                if rev.isdigit() and rev.isascii():
+                    return (parts[0], rev, '.' + parts[2] + '.' + parts[3])
+        return None
+
+    def add_node(self, entry, abspath, ns, st, data, names=None):
+        (name, rev, ext) = names or self.parse(entry)
         page = ns.getPage(name)
-        page.addRevision(rev, self.getsize(abspath))
+        rev = page.addRevision(rev, self.getsize(st))
+        self.addContent(rev, data)
+
+    def addContent(self, rev, content):
+        if not self.verify:
+            return
+        if content.isChecked():
+            self.setContent(rev, content)
+        else:
+            self.pending.append((rev, content))
+
+    def finish(self):
+        if self.pending:
+            verify([content for (rev, content) in self.pending], self.executor)
+            for rev, content in self.pending:
+                self.setContent(rev, content)
+            self.pending = []
+
+    def setContent(self, rev, content):
+        if content.error:
+            logging.error("Corrupt revision %s of %s: %s", rev.date, rev.node.getFullname(), content.error)
+            self.counters['errors'] += 1
+            rev.setContent(DokuFile.MISSING, None)
+        else:
+            rev.setContent(content.size, content.digest)
 
 class DokuMediaAttic(DokuAttic):
     """
@@ -138,36 +511,75 @@ class DokuMediaAttic(DokuAttic):
     ('fiche_inscription_v1', '1336687823', '.pdf')
     """
 
-    def __init__(self, doku):
-        super().__init__(doku, "media_attic")
+    def __init__(self, doku, manifest=None, executor=None, verify=False):
+        super().__init__(doku, "media_attic", manifest, executor, verify)
 
-    def add_node(self, entry, abspath, ns):
-        (name, rev, ext) = self.parse(entry)
+    def add_node(self, entry, abspath, ns, st, data, names=None):
+        (name, rev, ext) = names or self.parse(entry)
         media = ns.getMedia(name+ext)
-        media.addRevision(rev, self.getsize(abspath))
+        rev = media.addRevision(rev, self.getsize(st))
+        self.addContent(rev, data)
 
 class DokuMetaTree(DokuTree):
+    """
+    With a process pool `executor`, .changes files are not parsed while scanning, but all at once
+    by the pool in :py:meth:`finish`, before being joined to revisions.
+    """
 
-    def __init__(self, doku):
-        super().__init__(doku, "meta")
+    def __init__(self, doku, manifest=None, executor=None, verify=False):
+        super().__init__(doku, "meta", manifest, executor, verify)
+        self.pending = []
 
     def ignore(self, entry):
         return super().ignore(entry) or (entry.endswith('.trimmed')) or (entry == '_htcookiesalt')
 
-    def add_node(self, entry, abspath, ns):
-        (name, ext) = self.parse(entry)
+    def read(self, entry, abspath, st, names):
+        """Reads a meta file.
+
+        Returns a ``(size, contents)`` tuple: .changes files are parsed,
+        .meta files are kept serialized until their meta is needed.
+        Other files, such as .indexed ones, are only sized. Sizes other than those
+        of .meta files, which are read anyway, come from their `st` stat.
+        """
+        (name, ext) = names
+        if (ext == '.meta'):
+            with open(abspath, 'rb') as f:
+                data = f.read()
+            return (len(data), data)
+        if ext=='.changes':
+            log = DokuChangelog(abspath, st.st_size)
+            if self.executor is None:
+                log.read()
+            return (log.size, log)
+        return (st.st_size, None)
+
+    def add_node(self, entry, abspath, ns, st, data, names=None):
+        (name, ext) = names or self.parse(entry)
         page = ns.getPage(name)
-        size = self.getsize(abspath)
-        with open(abspath) as f:
-            contents = f.read()
+        (size, parsed) = data
         if ext=='.changes':
-            page.setChanges(contents)
+            if parsed.isParsed():
+                self.loadChanges(page, parsed)
+            else:
+                self.pending.append((page, parsed))
         elif (ext == '.indexed'):
-            page.setIndexed(contents)
+            page.loadIndexed(size)
         elif (ext == '.meta'):
-            page.setMeta(contents)
+            page.loadMeta(size, parsed)
         else:
             logging.warning("Unexpected meta entry : %s", entry)
+            self.counters['errors'] += 1
+
+    def finish(self):
+        if self.pending:
+            ingest([log for (page, log) in self.pending], self.executor)
+            for page, log in self.pending:
+                self.loadChanges(page, log)
+            self.pending = []
+
+    def loadChanges(self, page, log):
+        page.loadChanges(log)
+        self.counters['errors'] += log.errors
 
 
 if __name__ == "__main__":
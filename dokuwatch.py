@@ -0,0 +1,423 @@
+"""Keeps the sqlite database of a wiki current while its files change.
+
+The wiki is loaded and written into /tmp/doku-<name>.db once, as by doku2db, then its
+data trees are watched::
+
+    python dokuwatch.py s2m-sink /home/mich/services/sel2mers/wiki-maint --debounce 2
+
+Changes are collected per namespace, through inotify or, where it is not available,
+by polling directory and file mtimes. Once no change came for `debounce` seconds,
+or at the latest `latency` seconds after the first one, changed namespaces are loaded
+again into the namespace graph and synced into the database in a single transaction.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import signal
+import sqlite3
+import struct
+import time
+from doku import Doku
+from dokudb import DokuDbSync
+from dokutree import DokuScanManifest, private_dir
+
+__author__ = 'mich'
+
+#: Where per-wiki files go, followed by the wiki name, as for doku2db
+basename = "/tmp/doku-"
+
+
+class DokuInotify:
+    """Namespaces whose directories changed in the data trees, from Linux inotify events.
+
+    Every directory of the trees is watched, including those created later.
+    Raises OSError when inotify is not available, or when there are more directories
+    than allowed watches, see ``/proc/sys/fs/inotify/max_user_watches``.
+    """
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    #: Events watched: files written, touched, created, deleted or renamed
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    #: struct inotify_event, before its name
+    header = struct.Struct('iIII')
+
+    def __init__(self, datapath, trees):
+        """
+        :param trees: :py:class:`DokuTree` instances, for their names and ignored entries
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        #: tree name, namespace parts and directory of each watch descriptor
+        self.watches = {}
+        self.ignore = {tree.treename: tree.ignore for tree in trees}
+        try:
+            for tree in trees:
+                self.watch(tree.treename, (), os.path.join(datapath, tree.treename))
+        except OSError:
+            self.close()
+            raise
+        logging.info("Watching %d directories with inotify", len(self.watches))
+
+    def watch(self, treename, parts, dirpath):
+        """Watches `dirpath` and its subdirectories."""
+        stack = [(parts, dirpath)]
+        while stack:
+            (parts, dirpath) = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.mask)
+            if wd < 0:
+                code = ctypes.get_errno()
+                if code == errno.ENOENT:
+                    continue
+                raise OSError(code, "inotify_add_watch", dirpath)
+            self.watches[wd] = (treename, parts, dirpath)
+            try:
+                with os.scandir(dirpath) as it:
+                    stack.extend((parts + (e.name,), e.path) for e in it
+                                 if e.is_dir(follow_symlinks=False) and not self.ignore[treename](e.name))
+            except FileNotFoundError:
+                pass
+
+    def wait(self, timeout):
+        """Returns the parts of namespaces changed within `timeout` seconds, an empty set if none."""
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            i = 0
+            while i < len(data):
+                (wd, mask, cookie, length) = self.header.unpack_from(data, i)
+                name = os.fsdecode(data[i + self.header.size:i + self.header.size + length].rstrip(b'\0'))
+                i += self.header.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    logging.warning("Lost inotify events, rescanning all namespaces")
+                    changed.update(parts for (treename, parts, dirpath) in self.watches.values())
+                if wd not in self.watches:
+                    continue
+                (treename, parts, dirpath) = self.watches[wd]
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if name and self.ignore[treename](name):
+                    continue
+                changed.add(parts)
+                if mask & self.IN_ISDIR:
+                    changed.add(parts + (name,))
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.watch(treename, parts + (name,), os.path.join(dirpath, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DokuPoller:
+    """Namespaces whose directories changed in the data trees, from periodic scans:
+    the fallback of :py:class:`DokuInotify`.
+
+    Each scan compares directory mtimes, and for trees whose files may be modified
+    in place, file sizes and mtimes. Files of immutable trees are not stat'ed.
+    """
+
+    def __init__(self, datapath, trees, interval=2.0):
+        """
+        :param trees: :py:class:`DokuTree` instances, for their names, ignored entries and immutability
+        :param interval: seconds between scans
+        """
+        self.datapath = datapath
+        self.trees = [(tree.treename, tree.ignore, tree.immutable) for tree in trees]
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        """Returns the signature of every directory, by tree name and namespace parts."""
+        state = {}
+        for treename, ignore, immutable in self.trees:
+            stack = [((), os.path.join(self.datapath, treename))]
+            while stack:
+                (parts, dirpath) = stack.pop()
+                try:
+                    signature = [os.stat(dirpath).st_mtime_ns]
+                    with os.scandir(dirpath) as it:
+                        for e in it:
+                            if ignore(e.name):
+                                continue
+                            if e.is_dir():
+                                stack.append((parts + (e.name,), e.path))
+                            elif not immutable:
+                                st = e.stat()
+                                signature.append((e.name, st.st_size, st.st_mtime_ns))
+                except FileNotFoundError:
+                    continue
+                state[(treename, parts)] = tuple(signature)
+        return state
+
+    def wait(self, timeout):
+        """Returns the parts of namespaces changed within `timeout` seconds, an empty set if none."""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        (old, self.state) = (self.state, self.scan())
+        return {parts for (treename, parts) in old.keys() | self.state.keys()
+                if old.get((treename, parts)) != self.state.get((treename, parts))}
+
+    def close(self):
+        pass
+
+
+class DokuWatch:
+    """Keeps a :py:class:`Doku` site and its sqlite database current while files change.
+
+    Changed namespaces are loaded again from all data trees, so that their attic and meta
+    entries still find their pages and medias. New child namespaces are loaded,
+    vanished ones are dropped. The database is then updated by a :py:class:`DokuDbSync`
+    restricted to these namespaces, whose nodes and revisions not seen again are marked
+    as vanished, like a full sync does.
+
+    >>> import shutil, tempfile
+    >>> files = {'VERSION': '2013-05-10', 'data/pages/start.txt': 'hello', 'data/pages/ns0/page0.txt': 'hello',
+    ...          'data/pages/ns1/page1.txt': 'hello', 'data/attic/ns1/page1.1367320600.txt.gz': '',
+    ...          'data/meta/ns1/page1.changes': "1367320600\\t10.0.0.1\\tC\\tns1:page1\\tbob\\t\\t\\n",
+    ...          'data/media/logo.png': '', 'data/media_attic/logo.1367320600.png': ''}
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     for relpath, text in files.items():
+    ...         os.makedirs(os.path.dirname(os.path.join(path, relpath)), exist_ok=True)
+    ...         with open(os.path.join(path, relpath), 'w') as f:
+    ...             n = f.write(text)
+    ...     watch = DokuWatch(Doku(path), os.path.join(path, 'doku.db'), poll=True)
+    ...     watch.start()
+    ...     with open(os.path.join(path, 'data', 'pages', 'ns0', 'new.txt'), 'w') as f:
+    ...         n = f.write('Hello!')
+    ...     for tree in ('pages', 'attic', 'meta'):
+    ...         shutil.rmtree(os.path.join(path, 'data', tree, 'ns1'))
+    ...     changed = watch.source.wait(0)
+    ...     watch.apply(changed)
+    ...     rows = watch.conn.execute("SELECT fullname, name, size FROM nodes JOIN ns ON ns.id = ns_id "
+    ...                               "WHERE type = 'DokuPage' AND fullname != ':' ORDER BY 1, 2").fetchall()
+    ...     watch.close()
+    >>> sorted(changed)
+    [(), ('ns0',), ('ns1',)]
+    >>> rows
+    [(':ns0:', 'new', 6), (':ns0:', 'page0', 5), (':ns1:', 'page1', -1)]
+    >>> sorted(watch.wiki.root.children)
+    ['ns0']
+    """
+    #: PRAGMA settings of the database connection: write-ahead logging lets reports read
+    #: the last committed batch while the next one is written
+    pragmas = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+
+    def __init__(self, wiki, db, manifest=None, debounce=1.0, latency=10.0, interval=2.0, poll=False,
+                 rollups=False, verify=False):
+        """
+        :param db: sqlite database filename, synced if it exists
+        :param manifest: :py:class:`DokuScanManifest` filename, so that unchanged directories of a changed
+            namespace are not listed again
+        :param debounce: seconds without changes before they are applied
+        :param latency: seconds after which changes are applied, even if others keep coming
+        :param interval: seconds between polls, and between checks that the watch was stopped
+        :param poll: poll directories instead of using inotify
+        :param rollups: rebuild the node_stats and ns_stats tables after each batch,
+            see :py:attr:`DokuDbWriter.rollups`
+        :param verify: check the integrity of attic files, see :py:class:`DokuAtticContent`
+        """
+        self.wiki = wiki
+        self.db = db
+        self.manifest = manifest
+        self.debounce = debounce
+        self.latency = latency
+        self.interval = interval
+        self.poll = poll
+        self.rollups = rollups
+        self.verify = verify
+        self.datapath = wiki.root.getDataPath()
+        self.source = None
+        self.scan = None
+        self.conn = None
+        self.stopped = False
+
+    def trees(self):
+        return [cls(self.wiki.root, manifest=self.scan, verify=self.verify) for cls in Doku.trees]
+
+    def open(self):
+        """Returns the source of changes: inotify, unless polling was asked for or inotify fails."""
+        trees = self.trees()
+        if not self.poll:
+            try:
+                return DokuInotify(self.datapath, trees)
+            except OSError as e:
+                logging.warning("Polling directories, inotify failed: %s", e)
+        return DokuPoller(self.datapath, trees, self.interval)
+
+    def start(self):
+        """Loads the whole site and syncs the database, watching changes from the start."""
+        self.source = self.open()
+        self.wiki.load(manifest=self.manifest, verify=self.verify)
+        self.wiki.persist2db(self.db, sync=True, rollups=self.rollups)
+        if self.manifest:
+            self.scan = DokuScanManifest(self.manifest, self.datapath)
+            self.scan.update()
+        self.conn = sqlite3.connect(self.db)
+
+    def run(self):
+        """Applies changes until :py:meth:`stop` is called."""
+        pending = set()
+        (first, last) = (None, None)
+        while not self.stopped:
+            if pending:
+                timeout = max(0.0, min(last + self.debounce, first + self.latency) - time.monotonic())
+            else:
+                timeout = self.interval
+            changed = self.source.wait(timeout)
+            now = time.monotonic()
+            if changed:
+                pending |= changed
+                last = now
+                first = first or now
+            if pending and now >= min(last + self.debounce, first + self.latency):
+                self.apply(pending)
+                pending = set()
+                (first, last) = (None, None)
+        if pending:
+            self.apply(pending)
+
+    def stop(self):
+        self.stopped = True
+
+    def apply(self, changed):
+        """Loads namespaces of `changed` parts again and writes them into the database."""
+        metrics = self.wiki.metrics
+        with metrics.phase('watch.apply'):
+            trees = self.trees()
+            queue = sorted(changed, key=lambda parts: (len(parts), parts))
+            done = set()
+            reloaded = []
+            scope = set()
+            while queue:
+                parts = queue.pop(0)
+                if parts in done:
+                    continue
+                done.add(parts)
+                (ns, new) = self.reload(parts, trees, scope)
+                if ns is not None:
+                    reloaded.append(ns)
+                queue.extend(new)
+            writer = DokuDbSync(self.conn, pragmas=self.pragmas, rollups=self.rollups, namespaces=scope)
+            for ns in reloaded:
+                ns.persist2db(writer, recursive=False)
+            writer.close()
+        self.wiki.index = None
+        metrics.addRows(writer.written)
+        metrics.addCounters('watch', {'batches': 1, 'namespaces': len(scope),
+                                      'errors': sum(tree.counters['errors'] for tree in trees)})
+        logging.info("Applied changes of %d namespaces: %s", len(scope), writer.written)
+
+    def find(self, parts):
+        ns = self.wiki.root
+        for name in parts:
+            ns = ns.children.get(name)
+            if ns is None:
+                break
+        return ns
+
+    def reload(self, parts, trees, scope):
+        """Loads namespace `parts` again, adding its full name and those of dropped namespaces to `scope`.
+
+        Returns the namespace, None if it vanished, and the parts of its new children.
+        """
+        paths = [(tree, os.path.join(self.datapath, tree.treename, *parts)) for tree in trees]
+        ns = self.find(parts)
+        if not any(os.path.isdir(path) for (tree, path) in paths):
+            if ns is not None and parts:
+                del ns.parent.children[ns.name]
+                self.drop(parts, ns, scope)
+            return (None, [])
+        ns = self.wiki.root.getNamespacePath(parts)
+        ns.release()
+        scope.add(ns.fullname)
+        subdirs = {}
+        for tree, path in paths:
+            try:
+                files, subs = tree.scandir(parts, path)
+            except FileNotFoundError:
+                continue
+            tree.apply(ns, [((), files)])
+            tree.finish()
+            subdirs.update(subs)
+        for name in [name for name in ns.children if name not in subdirs]:
+            self.drop(parts + (name,), ns.children.pop(name), scope)
+        return (ns, [parts + (name,) for name in subdirs if name not in ns.children])
+
+    def drop(self, parts, ns, scope):
+        stack = [ns]
+        while stack:
+            ns = stack.pop()
+            scope.add(ns.fullname)
+            stack.extend(ns.children.values())
+        if self.scan:
+            self.scan.forget(parts)
+
+    def close(self):
+        """Stops watching, saving the scan manifest."""
+        if self.source:
+            self.source.close()
+        if self.scan:
+            self.scan.save()
+        if self.conn:
+            self.conn.close()
+
+
+def dokuwatch(name, path, **options):
+    """Watches the `name` wiki at `path`, keeping /tmp/doku-<name>.db current until
+    interrupted, then writes the JSON metrics report alongside.
+    The scan manifest is shared with doku2db, in the private directory /tmp/doku-<name>.state.
+
+    `options` are those of :py:class:`DokuWatch`.
+    """
+    manifest = os.path.join(private_dir(basename + name + ".state"), "manifest")
+    watch = DokuWatch(Doku(path), basename + name + ".db", manifest=manifest, **options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watch.stop())
+    watch.start()
+    try:
+        watch.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.close()
+    watch.wiki.metrics.dump(basename + name + ".metrics.json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('name', help="wiki name, for /tmp/doku-<name> files")
+    parser.add_argument('path', help="wiki directory")
+    parser.add_argument('--debounce', type=float, default=1.0, help="seconds without changes before a batch")
+    parser.add_argument('--latency', type=float, default=10.0, help="longest delay of a change")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between polls")
+    parser.add_argument('--poll', action='store_true', help="poll directories instead of using inotify")
+    parser.add_argument('--rollups', action='store_true', help="rebuild rollup tables after each batch")
+    parser.add_argument('--verify', action='store_true', help="check attic files")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    dokuwatch(args.name, args.path, debounce=args.debounce, latency=args.latency, interval=args.interval,
+              poll=args.poll, rollups=args.rollups, verify=args.verify)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,4 +15,33 @@ left join revisions R on R.node_id=N.id
 group by ns.fullname, N.id, N.type, N.name, N.size, N.sz_changes,
   N.sz_indexed, N.sz_meta
 order by N.name;
--- make sure you get the same row count as table nodes.
\ No newline at end of file
+-- make sure you get the same row count as table nodes.
+
+-- Same overview from the node_stats rollup (doku2db builds it), without scanning revisions
+drop view if exists overview_stats;
+create view overview_stats as
+select ns.fullname,  N.id, N.type, N.name, N.size, N.sz_changes,
+  N.sz_indexed, N.sz_meta, S.rev_count, S.first_time, S.last_time, S.attic_bytes
+from nodes N
+inner join ns on ns.id=N.ns_id
+inner join node_stats S on S.node_id=N.id
+order by N.name;
+
+-- Namespaces by attic weight
+select ns.fullname, S.*
+from ns_stats S
+inner join ns on ns.id=S.ns_id
+order by S.attic_bytes desc;
+
+-- Identical medias, under whatever name, largest waste first (needs doku2db dedup)
+select D.digest, D.size, count(*) as copies, D.size * (count(*) - 1) as wasted,
+  group_concat(D.path, ' ') as paths
+from duplicates D
+group by D.digest, D.size
+order by wasted desc;
+
+-- Files lacking their counterpart in another tree, by class (needs doku2db check)
+select A.class, count(*) as anomalies, count(distinct A.node_id) as nodes
+from anomalies A
+group by A.class
+order by anomalies desc;